@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-plugin aiohttp routes vs the PluginDispatcher table.
+
+The "router" case registers the four routes per plugin pserv used to register
+(GET/POST, with and without {tail:.*}) and looks the plugin up again through an
+async get_plugin, as the old handler did. The "dispatcher" case registers the
+single catch-all route and resolves the plugin with PluginDispatcher.resolve.
+
+usage: bench_dispatch.py [-n iterations] [-p plugin counts]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plugincore.dispatcher import PluginDispatcher
+
+async def _handler(request):
+    return web.Response()
+
+def control_routes(router):
+    router.add_route('GET', '/plugins', _handler)
+    router.add_route('POST', '/plugins', _handler)
+    router.add_route('GET', '/reload/all', _handler)
+    router.add_route('POST', '/reload/all', _handler)
+    router.add_route('GET', '/reload/{plugin_id}', _handler)
+    router.add_route('POST', '/reload/{plugin_id}', _handler)
+
+def build_router_app(plugins):
+    app = web.Application()
+    for pid in plugins:
+        app.router.add_route('GET', f'/{pid}', _handler)
+        app.router.add_route('GET', f'/{pid}/{{tail:.*}}', _handler)
+        app.router.add_route('POST', f'/{pid}', _handler)
+        app.router.add_route('POST', f'/{pid}/{{tail:.*}}', _handler)
+    control_routes(app.router)
+    app.freeze()
+    return app
+
+def build_dispatch_app():
+    app = web.Application()
+    control_routes(app.router)
+    app.router.add_route('GET', '/{path:.*}', _handler)
+    app.router.add_route('POST', '/{path:.*}', _handler)
+    app.freeze()
+    return app
+
+async def bench_router(app, plugins, paths, iterations):
+    async def get_plugin(pid):
+        return plugins.get(pid)
+    requests = [make_mocked_request('GET', p, app=app) for p in paths]
+    start = time.perf_counter()
+    for i in range(iterations):
+        req = requests[i % len(requests)]
+        match = await app.router.resolve(req)
+        pid = match.route.resource.canonical.split('/')[1]
+        plugin = await get_plugin(pid)
+        subpath = match.get('tail')
+    return time.perf_counter() - start
+
+async def bench_dispatcher(app, plugins, paths, iterations):
+    table = PluginDispatcher(plugins)
+    requests = [make_mocked_request('GET', p, app=app) for p in paths]
+    start = time.perf_counter()
+    for i in range(iterations):
+        req = requests[i % len(requests)]
+        match = await app.router.resolve(req)
+        pid, plugin, subpath = table.resolve(match['path'])
+    return time.perf_counter() - start
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=50000)
+    parser.add_argument('-p', '--plugins', type=int, nargs='+', default=[3, 12, 50, 200])
+    args = parser.parse_args()
+
+    print(f"{'plugins':>8} {'router us/req':>14} {'dispatch us/req':>16} {'speedup':>8}")
+    for count in args.plugins:
+        plugins = {f"plugin{n}": object() for n in range(count)}
+        # hit a spread of plugins, the last registered ones are the router's worst case
+        ids = list(plugins)
+        paths = [f"/{pid}/some/sub/path" for pid in ids[::max(1, count // 8)]] + [f"/{ids[-1]}"]
+        router = await bench_router(build_router_app(plugins), plugins, paths, args.iterations)
+        dispatch = await bench_dispatcher(build_dispatch_app(), plugins, paths, args.iterations)
+        print(f"{count:>8} {router / args.iterations * 1e6:>14.2f} "
+              f"{dispatch / args.iterations * 1e6:>16.2f} {router / dispatch:>7.1f}x")
+
+if __name__ == '__main__':
+    asyncio.run(main())
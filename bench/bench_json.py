@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark the json codecs selectable with [server] json= on the systeminfo payload.
+
+Each simulated request decodes a small POST body and encodes the full
+systeminfo response to bytes, which is the work the server does per request.
+Codecs that aren't installed are skipped.
+
+usage: bench_json.py [-n requests]
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plugincore import jsoncodec
+
+# psutil hands systeminfo namedtuples for these
+scpufreq = collections.namedtuple('scpufreq', 'current min max')
+scputimes = collections.namedtuple('scputimes', 'user nice system idle iowait irq softirq steal guest guest_nice')
+scpustats = collections.namedtuple('scpustats', 'ctx_switches interrupts soft_interrupts syscalls')
+
+def systeminfo_payload():
+    return {
+        'error': 'nodata',
+        'net': [{'iface': f"eth{n}", 'address': f"10.0.{n}.17/24", 'tx': '12.5kbps', 'rx': '1.02mbps'} for n in range(4)],
+        'cpu': {
+            'cpu_model': 'Intel(R) Xeon(R) Gold 6230R CPU @ 2.10GHz',
+            'cpu_count': 16,
+            'cpu_freq': scpufreq(2100.0, 800.0, 4000.0),
+            'loadavg': (0.42, 0.37, 0.31),
+            'percent': 3.4,
+            'times': scputimes(101234.1, 12.3, 20345.6, 9876543.2, 345.6, 0.0, 123.4, 0.0, 0.0, 0.0),
+            'stats': scpustats(987654321, 123456789, 23456789, 0),
+        },
+        'uptime': {'pretty': 'up 3 weeks, 2 days, 4 hours, 17 minutes', 'seconds': 41},
+        'disk': [{
+            'friendly_dev': f"nvme0n1p{n}", 'dev': f"UUID=0c8b{n}e2a-7d61-4b6e-9a1f-3f0c2e5d7b{n}",
+            'mount': f"/srv/vol{n}", 'fstype': 'ext4', 'total': 982141468672, 'free': 512341468672,
+            'used': 469800000000, 'percent': 48} for n in range(6)],
+        'upgrades': {'Upgradable packages': 12},
+        'ram': {
+            'total': 67430322176, 'free': 30238429184, 'used': 20398202880, 'cached': 15234048000,
+            'percent': 31.2, 'active': 18234048000, 'buffers': 1024000000, 'inactive': 12034048000,
+            'shared': 512000000, 'slab': 1234048000},
+        'info': {
+            'machine': 'x86_64', 'sysname': 'Linux', 'version': '#1 SMP PREEMPT_DYNAMIC Debian 6.1.76-1',
+            'release': '6.1.0-18-amd64', 'nodename': 'pi4.example.com'},
+    }
+
+REQUEST_BODY = b'{"apikey": "deadbeef", "session_id": "9f0b3c1e-5a1d-4d1e-8b3a-2f5e6c7d8e9f", "data": {"user": "nicole", "theme": "dark"}}'
+
+def run(codec, payload, count):
+    jsoncodec.use(codec)
+    loads, dumpb = jsoncodec.loads, jsoncodec.dumpb
+    size = len(dumpb(payload))
+    start = time.perf_counter()
+    for _ in range(count):
+        loads(REQUEST_BODY)
+        dumpb(payload)
+    return time.perf_counter() - start, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--requests', type=int, default=50000)
+    args = parser.parse_args()
+
+    payload = systeminfo_payload()
+    print(f"{'codec':>8} {'req/s':>12} {'us/req':>8} {'bytes':>7}")
+    for codec in jsoncodec.CODECS:
+        if jsoncodec.use(codec) != codec:
+            print(f"{codec:>8} {'not installed':>12}")
+            continue
+        elapsed, size = run(codec, payload, args.requests)
+        print(f"{codec:>8} {args.requests / elapsed:>12,.0f} {elapsed / args.requests * 1e6:>8.2f} {size:>7}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Benchmark the per-request cost of a debug log line at DEBUG and INFO thresholds.
+
+The message is sessman's response_handler line with a session payload. Three
+call styles are compared:
+    eager   log.debug(f"...{response_data}")       message built on every call
+    lazy    log.debugf("... %s", response_data)    built only when written
+    guarded if log.isEnabledFor('DEBUG'): ...      skips the call entirely
+
+Output is sent to /dev/null while measuring, so the DEBUG numbers show the
+formatting and write cost without a terminal in the way.
+
+usage: bench_logging.py [-n requests]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plugincore import logjam
+
+response_data = {
+    'session_id': '9f0b3c1e-5a1d-4d1e-8b3a-2f5e6c7d8e9f',
+    'data': {'user': 'nicole', 'theme': 'dark', 'cart': [{'sku': f"SKU{n:05d}", 'qty': n % 3 + 1} for n in range(20)]},
+}
+plugin_id, code = 'sessman', 200
+
+def eager(log):
+    log.debug(f"{plugin_id}: response_handler {code}, {response_data}")
+
+def lazy(log):
+    log.debugf("%s: response_handler %s, %s", plugin_id, code, response_data)
+
+def guarded(log):
+    if log.isEnabledFor('DEBUG'):
+        log.debug(f"{plugin_id}: response_handler {code}, {response_data}")
+
+def measure(style, log, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        style(log)
+    return (time.perf_counter() - start) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--requests', type=int, default=100000)
+    args = parser.parse_args()
+
+    results = []
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        for level in ('DEBUG', 'INFO'):
+            log = logjam.LogJam(name='bench', level=level, stdio=False)
+            for style in (eager, lazy, guarded):
+                results.append((level, style.__name__, measure(style, log, args.requests)))
+    finally:
+        os.dup2(saved, 1)
+        os.close(devnull)
+    print(f"{'threshold':>9} {'style':>8} {'us/request':>11}")
+    for level, style, us in results:
+        print(f"{level:>9} {style:>8} {us:>11.3f}")
+
+if __name__ == '__main__':
+    main()
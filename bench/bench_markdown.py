@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Markdown page rendering: per-call setup vs the cached converter and envelope.
+
+"before" renders each page the way ServeFiles.markdown_to_html used to:
+markdown.markdown() with a fresh set of extensions, the envelope read from
+disk and the field regex compiled on every call. "after" uses fileserve's
+markdown_body (a reused Markdown instance) and a compiled Envelope.
+
+The corpus is every *.md file under the given directories (the repo's docs by
+default). Both paths are checked to produce the same html before timing.
+
+usage: bench_markdown.py [-n rounds] [dir ...]
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import tempfile
+import time
+import markdown
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'plugins'))
+import fileserve
+
+ENVELOPE = """<!DOCTYPE html>
+<html>
+<head>
+    <title>{title}</title>
+    <link rel="stylesheet" href="{markdown_css}">
+    <link rel="stylesheet" href="{highlight_css}">
+</head>
+<body>
+{mdhtml}
+</body>
+</html>"""
+
+def context(title, mdhtml):
+    return {"title": title, "markdown_css": "markdown.css", "highlight_css": "highlight.css", "mdhtml": mdhtml}
+
+def before(text, title, envelope_path):
+    mdhtml = markdown.markdown(text, extensions=['fenced_code', 'tables','codehilite'])
+    with open(envelope_path) as f:
+        env = f.read()
+    values = context(title, mdhtml)
+    pattern = re.compile(r'{(?:self\.)?(\w+)}')
+    return pattern.sub(lambda m: str(values.get(m.group(1), m.group(0))), env)
+
+def after(text, title, envelope):
+    return envelope.render(context(title, fileserve.markdown_body(text)))
+
+def main():
+    default_docs = os.path.join(root, 'docs')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rounds', type=int, default=20)
+    parser.add_argument('dirs', nargs='*', default=[default_docs])
+    args = parser.parse_args()
+
+    corpus = []
+    for d in args.dirs:
+        for path in sorted(glob.glob(os.path.join(d, '**', '*.md'), recursive=True)):
+            with open(path) as f:
+                corpus.append((os.path.basename(path), f.read()))
+    if not corpus:
+        sys.exit(f"no markdown files in {', '.join(args.dirs)}")
+    size = sum(len(text) for _, text in corpus)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False) as f:
+        f.write(ENVELOPE)
+        envelope_path = f.name
+    try:
+        envelope = fileserve.Envelope(ENVELOPE)
+        for title, text in corpus:
+            if before(text, title, envelope_path) != after(text, title, envelope):
+                sys.exit(f"output differs for {title}")
+        results = []
+        for name, render, arg in (('before', before, envelope_path), ('after', after, envelope)):
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                for title, text in corpus:
+                    render(text, title, arg)
+            results.append((name, (time.perf_counter() - start) / (args.rounds * len(corpus))))
+    finally:
+        os.unlink(envelope_path)
+
+    print(f"{len(corpus)} documents, {size // 1024}KB, {args.rounds} rounds")
+    print(f"{'path':>8} {'ms/page':>9} {'pages/s':>9}")
+    for name, seconds in results:
+        print(f"{name:>8} {seconds * 1000:>9.3f} {1 / seconds:>9.1f}")
+    print(f"speedup {results[0][1] / results[1][1]:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Latency of a light plugin while ServeFiles renders big markdown pages.
+
+Runs against a server that is already up. One client probes --probe
+(/systeminfo by default) at a fixed interval and records its latency while
+--renderers clients fetch --page back to back. Run it once with
+-r 0 for the idle baseline, then with renderers, and compare the p99 for
+render_workers=0 (rendering on the event loop) against a thread or process
+pool.
+
+The render cache would answer every request after the first, so give the
+file server render_cache=int:0 while benchmarking. --make-doc writes a large
+markdown page with tables and highlighted code to serve as --page.
+
+usage: bench_render_latency.py [-u url] [-p page] [-r renderers] [-d seconds]
+       bench_render_latency.py --make-doc docs/big.md [--kb 512]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import aiohttp
+
+def make_doc(path, kb):
+    section = ["## Section {n}", "",
+               "Some *text* with `code`, a [link](https://example.com) and **emphasis**.", "",
+               "| key | value | notes |", "|-----|-------|-------|"]
+    section += [f"| k{{n}}_{i} | {i * 7} | row {i} |" for i in range(10)]
+    section += ["", "```python", "def handler_{n}(request):",
+                "    data = {{'id': {n}, 'items': [i * i for i in range(10)]}}",
+                "    return 200, data", "```", ""]
+    template = '\n'.join(section)
+    out, n, size = ["# Render benchmark", ""], 0, 0
+    while size < kb * 1024:
+        chunk = template.format(n=n)
+        out.append(chunk)
+        size += len(chunk)
+        n += 1
+    with open(path, 'w') as f:
+        f.write('\n'.join(out))
+    print(f"wrote {path}: {size // 1024}KB, {n} sections")
+
+async def probe(session, url, headers, interval, until, latencies):
+    while time.monotonic() < until:
+        start = time.perf_counter()
+        async with session.get(url, headers=headers) as resp:
+            await resp.read()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+
+async def render(session, url, headers, until, counts):
+    while time.monotonic() < until:
+        async with session.get(url, headers=headers) as resp:
+            await resp.read()
+            counts[resp.status] = counts.get(resp.status, 0) + 1
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def run(args):
+    headers = {'Authorization': f"Bearer {args.apikey}"} if args.apikey else {}
+    until = time.monotonic() + args.duration
+    latencies, counts = [], {}
+    connector = aiohttp.TCPConnector(limit=args.renderers + 1)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        jobs = [probe(session, args.url + args.probe, headers, args.interval, until, latencies)]
+        jobs += [render(session, args.url + args.page, headers, until, counts) for _ in range(args.renderers)]
+        await asyncio.gather(*jobs)
+    ms = [v * 1000 for v in latencies]
+    print(f"{args.probe} with {args.renderers} renderers on {args.page} for {args.duration}s")
+    print(f"  probes {len(ms)}  p50 {percentile(ms, 50):.2f}ms  p90 {percentile(ms, 90):.2f}ms  "
+          f"p99 {percentile(ms, 99):.2f}ms  max {max(ms):.2f}ms  mean {statistics.mean(ms):.2f}ms")
+    if counts:
+        print(f"  page responses {sum(counts.values())} by status {counts}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:9192')
+    parser.add_argument('--probe', default='/systeminfo')
+    parser.add_argument('-p', '--page', default='/docs/big.md')
+    parser.add_argument('-r', '--renderers', type=int, default=4)
+    parser.add_argument('-d', '--duration', type=float, default=20.0)
+    parser.add_argument('-i', '--interval', type=float, default=0.02, help="seconds between probes")
+    parser.add_argument('-k', '--apikey', help="sent as a Bearer token")
+    parser.add_argument('--make-doc', metavar='FILE', help="write a markdown page to render and exit")
+    parser.add_argument('--kb', type=int, default=512, help="size of the page written by --make-doc")
+    args = parser.parse_args()
+    if args.make_doc:
+        make_doc(args.make_doc, args.kb)
+        return
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
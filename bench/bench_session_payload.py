@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Session payload encodings: encode and decode time, payload size and database
+size, for a typical 1KB and 64KB session.
+
+"legacy" is the old format, JSON text base64 encoded into a TEXT column. The
+others are sessman.SessionPayload configurations stored as BLOBs; msgpack and
+zstd are left out when their packages aren't installed. The database size is
+the page count of a temporary sqlite file holding --rows copies of the
+session, after a VACUUM.
+
+usage: bench_session_payload.py [-n rounds] [-r rows] [--sizes 1,64]
+"""
+import argparse
+import base64
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'plugins'))
+from plugincore import jsoncodec
+import sessman
+
+def make_session(kb):
+    session = {'user': {'id': 48213, 'name': 'bench user', 'email': 'bench@example.com', 'roles': ['user', 'beta']},
+               'prefs': {'theme': 'dark', 'lang': 'en-US', 'tz': 'America/New_York', 'page_size': 50},
+               'csrf': '5f2b6c8e9a0d4e1fa3b7c9d2e4f60718', 'cart': [], 'history': []}
+    n = 0
+    while len(jsoncodec.dumpb(session)) < kb * 1024:
+        session['cart'].append({'sku': f"SKU{n:06d}", 'qty': n % 4 + 1, 'price': round(4.99 + n * 1.25, 2),
+                                'title': f"Item {n} in a fairly ordinary product line"})
+        session['history'].append({'path': f"/shop/category/{n % 12}/item/{n}", 'ts': 1700000000 + n * 37})
+        n += 1
+    return session
+
+class Legacy:
+    """ the base64 JSON text sessman stored before the payload format """
+    def encode(self, data):
+        return base64.b64encode(jsoncodec.dumpb(data)).decode('utf-8')
+
+def codecs():
+    yield 'legacy', Legacy()
+    for serializer in ('json', 'msgpack'):
+        for compression in ('none', 'zlib', 'zstd'):
+            try:
+                yield f"{serializer}+{compression}", sessman.SessionPayload(serializer=serializer, compression=compression)
+            except ValueError:
+                pass
+
+def timed(fn, arg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.perf_counter() - start) / rounds
+
+def db_size(value, rows, column):
+    with tempfile.TemporaryDirectory() as tmp:
+        con = sqlite3.connect(os.path.join(tmp, 'sessions.db'))
+        con.execute(f"CREATE TABLE sessions (session_id TEXT NOT NULL UNIQUE, data {column} NOT NULL)")
+        with con:
+            con.executemany("INSERT INTO sessions VALUES (?, ?)", ((f"{n:032x}", value) for n in range(rows)))
+        con.execute("VACUUM")
+        size = con.execute("PRAGMA page_count").fetchone()[0] * con.execute("PRAGMA page_size").fetchone()[0]
+        con.close()
+    return size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rounds', type=int, default=500)
+    parser.add_argument('-r', '--rows', type=int, default=200, help="sessions written for the database size")
+    parser.add_argument('--sizes', default='1,64', type=lambda v: [int(n) for n in v.split(',')],
+                        help="session sizes in KB")
+    args = parser.parse_args()
+
+    for kb in args.sizes:
+        session = make_session(kb)
+        raw = len(jsoncodec.dumpb(session))
+        rounds = max(1, args.rounds // kb)
+        print(f"\n{kb}KB session ({raw} bytes of JSON), {rounds} rounds, {args.rows} rows")
+        print(f"{'format':>15} {'encode us':>10} {'decode us':>10} {'bytes':>8} {'db KB':>8}")
+        for name, codec in codecs():
+            value = codec.encode(session)
+            if sessman.SessionPayload.decode(value) != session:
+                sys.exit(f"{name} does not round trip")
+            encode = timed(codec.encode, session, rounds)
+            decode = timed(sessman.SessionPayload.decode, value, rounds)
+            size = db_size(value, args.rows, 'TEXT' if isinstance(value, str) else 'BLOB')
+            print(f"{name:>15} {encode * 1e6:>10.1f} {decode * 1e6:>10.1f} {len(value):>8} {size // 1024:>8}")
+
+if __name__ == '__main__':
+    main()
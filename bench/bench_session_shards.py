@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Load test of the sharded sqlite session store: create, get and update
+throughput as the number of shards grows.
+
+For each shard count a fresh store is made in a temporary directory and
+--sessions sessions are created. Then --tasks concurrent tasks run each
+operation for --duration seconds against random sessions (create makes new
+ones). Writes to different shards run on different writer threads, so create
+and update should scale with shards until the disk or the event loop is the
+limit; gets mostly show the cost of the extra threads. --synchronous FULL
+makes every commit wait for the disk, which is where sharding helps most.
+
+usage: bench_session_shards.py [--shards 1,2,4,8] [-t tasks] [-d seconds] [--synchronous NORMAL]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'plugins'))
+from plugincore import logjam
+import sessman
+
+PAYLOAD = {'user': 'bench', 'theme': 'dark', 'cart': [{'sku': f"SKU{n:05d}", 'qty': n % 3 + 1} for n in range(10)]}
+OPS = ('create', 'get', 'update')
+
+async def worker(op, backend, sessions, until, counts):
+    done = 0
+    while time.monotonic() < until:
+        if op == 'create':
+            await backend.create_session(client_ip='127.0.0.1', data=PAYLOAD)
+        elif op == 'get':
+            await backend.get_session(session_id=random.choice(sessions), client_ip='127.0.0.1')
+        else:
+            await backend.update_session(session_id=random.choice(sessions), client_ip='127.0.0.1', data=PAYLOAD)
+        done += 1
+    counts.append(done)
+
+async def run(args, shards, database):
+    log = logjam.LogJam(name='bench', level='ERROR')
+    backend = await sessman.SessionDbHandler('sqlite', database=database, collection='sessions', log=log,
+                                             shards=shards, readers=args.readers, synchronous=args.synchronous,
+                                             vacuum_interval=3600)
+    results = {}
+    try:
+        sessions = await asyncio.gather(*[backend.create_session(client_ip='127.0.0.1', data=PAYLOAD)
+                                          for _ in range(args.sessions)])
+        for op in OPS:
+            counts = []
+            until = time.monotonic() + args.duration
+            await asyncio.gather(*[worker(op, backend, sessions, until, counts) for _ in range(args.tasks)])
+            results[op] = sum(counts) / args.duration
+    finally:
+        backend.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', default='1,2,4,8', type=lambda v: [int(n) for n in v.split(',')])
+    parser.add_argument('-t', '--tasks', type=int, default=64)
+    parser.add_argument('-d', '--duration', type=float, default=5.0)
+    parser.add_argument('-s', '--sessions', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=1, help="reader threads per shard")
+    parser.add_argument('--synchronous', default='NORMAL')
+    args = parser.parse_args()
+
+    print(f"{args.tasks} tasks, {args.duration}s per operation, synchronous={args.synchronous}")
+    print(f"{'shards':>6} " + ' '.join(f"{op + '/s':>10} {'x':>5}" for op in OPS))
+    base = None
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = asyncio.run(run(args, shards, os.path.join(tmp, 'sessions.db')))
+        base = base or results
+        print(f"{shards:>6} " + ' '.join(f"{results[op]:>10.0f} {results[op] / base[op]:>5.2f}" for op in OPS))
+
+if __name__ == '__main__':
+    main()
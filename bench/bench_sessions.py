@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Sessions per second for a session backend, get and update, at several
+concurrency levels.
+
+The backend is filled with --sessions sessions, then for each concurrency
+level that many tasks call get_session (or update_session) on random
+sessions for --duration seconds. The backend is used directly, so the
+numbers show the database path without HTTP in front of it.
+
+sqlite runs on a temporary database file. mongodb needs a server, a local
+mongod is enough; the sessions are created in --collection (default
+bench_sessions) and that collection is dropped afterwards.
+
+usage: bench_sessions.py [-c 1,4,16,64] [-d seconds] [-s sessions] [--readers n]
+       bench_sessions.py -b mongodb --server-url localhost:27017 --database db -U user -P password
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'plugins'))
+from plugincore import logjam
+import sessman
+
+PAYLOAD = {'user': 'bench', 'theme': 'dark', 'cart': [{'sku': f"SKU{n:05d}", 'qty': n % 3 + 1} for n in range(10)]}
+
+async def worker(op, backend, sessions, until, counts):
+    done = 0
+    while time.monotonic() < until:
+        session_id = random.choice(sessions)
+        if op == 'get':
+            await backend.get_session(session_id=session_id, client_ip='127.0.0.1')
+        else:
+            await backend.update_session(session_id=session_id, client_ip='127.0.0.1', data=PAYLOAD)
+        done += 1
+    counts.append(done)
+
+async def run(args, database):
+    log = logjam.LogJam(name='bench', level='ERROR')
+    if args.backend == 'mongodb':
+        backend = await sessman.SessionDbHandler('mongodb', database=args.database, collection=args.collection,
+                                                 server_url=args.server_url, username=args.username,
+                                                 password=args.password, pool_size=args.pool_size, log=log)
+    else:
+        backend = await sessman.SessionDbHandler('sqlite', database=database, collection='sessions',
+                                                 log=log, readers=args.readers, synchronous=args.synchronous,
+                                                 vacuum_interval=3600)
+    try:
+        sessions = [await backend.create_session(client_ip='127.0.0.1', data=PAYLOAD) for _ in range(args.sessions)]
+        print(f"{'op':>6} {'tasks':>6} {'sessions/s':>11}")
+        for level in args.concurrency:
+            for op in ('get', 'update'):
+                counts = []
+                until = time.monotonic() + args.duration
+                await asyncio.gather(*[worker(op, backend, sessions, until, counts) for _ in range(level)])
+                print(f"{op:>6} {level:>6} {sum(counts) / args.duration:>11.0f}")
+    finally:
+        if args.backend == 'mongodb':
+            await backend.sessions.drop()
+        closing = backend.close()
+        if asyncio.iscoroutine(closing):
+            await closing
+        await asyncio.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--concurrency', default='1,4,16,64',
+                        type=lambda v: [int(n) for n in v.split(',')])
+    parser.add_argument('-d', '--duration', type=float, default=5.0)
+    parser.add_argument('-s', '--sessions', type=int, default=1000)
+    parser.add_argument('-b', '--backend', choices=('sqlite', 'mongodb'), default='sqlite')
+    parser.add_argument('--readers', type=int, default=2, help="sqlite reader threads")
+    parser.add_argument('--synchronous', default='NORMAL', help="sqlite synchronous setting")
+    parser.add_argument('--server-url', default='localhost:27017', help="mongodb host:port")
+    parser.add_argument('--database', default='sessman', help="mongodb database")
+    parser.add_argument('--collection', default='bench_sessions', help="mongodb collection, dropped afterwards")
+    parser.add_argument('-U', '--username', help="mongodb user")
+    parser.add_argument('-P', '--password', help="mongodb password")
+    parser.add_argument('--pool-size', type=int, default=100, help="mongodb connection pool size")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(args, os.path.join(tmp, 'sessions.db')))
+
+if __name__ == '__main__':
+    main()
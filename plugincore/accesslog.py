@@ -0,0 +1,220 @@
+"""
+Access log for pserv.
+
+One line is recorded for every request, in Common Log Format or as JSON lines.
+Lines are collected in memory and handed to a single writer thread when the
+buffer fills up or flush_interval passes, so the event loop never waits on the
+disk. The writer rotates the file when it grows past max_bytes.
+
+Configured in the [access_log] section:
+
+    [access_log]
+    file=/var/log/pserv/access.log      # {pid} is replaced with the process id
+    log_format=common                   # common or json
+    buffer_size=int:65536               # bytes buffered before a write
+    flush_interval=float:1.0            # seconds between writes
+    max_bytes=int:104857600             # rotate past this size, 0 never rotates
+    backups=int:5                       # rotated files kept
+    sample=float:1.0                    # fraction of requests logged
+
+The key names must get past configfile.Config, which refuses python
+builtins and keywords (hence log_format, not format). Running
+
+    python -m plugincore.accesslog [pserv.ini]
+
+parses the [access_log] section of the ini file, or SAMPLE_CONFIG, the way
+the server does and prints the settings it ends up with.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from plugincore import jsoncodec
+
+FORMATS = ('common', 'json')
+
+# a response sent in pieces (a prepared StreamResponse or a FileResponse)
+# carries its payload byte count under this key for the size field
+PAYLOAD_BYTES = 'pserv.payload_bytes'
+
+SAMPLE_CONFIG = """
+[access_log]
+file=/tmp/pserv-access.log
+log_format=json
+buffer_size=int:65536
+flush_interval=float:1.0
+max_bytes=int:104857600
+backups=int:5
+sample=float:1.0
+"""
+
+class AccessLog:
+    def __init__(self, path, *, log_format='common', buffer_size=65536, flush_interval=1.0,
+                 max_bytes=0, backups=5, sample=1.0, log=None):
+        if log_format not in FORMATS:
+            raise ValueError(f"access log log_format must be one of {', '.join(FORMATS)}, not {log_format}")
+        self.path = os.path.expanduser(path.replace('{pid}', str(os.getpid())))
+        self.log_format = log_format
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample = sample
+        self.log = log
+        self.records = 0
+        self.sampled_out = 0
+        self._buffer = []
+        self._buffered = 0
+        self._fh = None
+        self._clf_second = None
+        self._clf_time = ''
+        self._task = None
+        self.closed = False
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='accesslog')
+
+    def start(self):
+        """ start the periodic flush, must be called with the event loop running """
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher(), name="accesslog:flusher")
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def _clf_timestamp(self, now):
+        second = int(now)
+        if second != self._clf_second:
+            self._clf_second = second
+            self._clf_time = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(second))
+        return self._clf_time
+
+    def record(self, *, client_ip, method, path, protocol, status, size, plugin=None, latency=0.0):
+        """
+        record one request. Requests that failed (status >= 500) are always
+        recorded, others are subject to sampling. Does nothing once the log
+        is closed.
+        """
+        if self.closed:
+            return
+        if self.sample < 1.0 and status < 500 and random.random() >= self.sample:
+            self.sampled_out += 1
+            return
+        now = time.time()
+        if self.log_format == 'json':
+            line = jsoncodec.dumps({
+                'time': round(now, 3),
+                'client_ip': client_ip,
+                'method': method,
+                'path': path,
+                'protocol': protocol,
+                'plugin': plugin,
+                'status': status,
+                'bytes': size,
+                'latency_ms': round(latency * 1000, 3),
+            })
+        else:
+            line = (f'{client_ip} - - [{self._clf_timestamp(now)}] "{method} {path} {protocol}" '
+                    f'{status} {size if size is not None else "-"}')
+        self._buffer.append(line)
+        self._buffered += len(line) + 1
+        self.records += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ hand the buffered lines to the writer thread """
+        if self.closed or not self._buffer:
+            return
+        self._buffer.append('')
+        data = '\n'.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._writer.submit(self._write, data)
+
+    def _write(self, data):
+        try:
+            if self._fh is None:
+                self._fh = open(self.path, 'a')
+            if self.max_bytes and self._fh.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            self._fh.write(data)
+            self._fh.flush()
+        except Exception as e:
+            if self.log:
+                self.log.error(f"access log {self.path}: {type(e).__name__}: {e}")
+
+    def _rotate(self):
+        self._fh.close()
+        self._fh = None
+        if self.backups > 0:
+            for n in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{n}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{n + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+        self._fh = open(self.path, 'a')
+
+    def close(self):
+        """ stop the periodic flush, write what's buffered and close the file """
+        if self.closed:
+            return
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+        self.closed = True
+        self._writer.shutdown(wait=True)
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+
+def from_config(config, log=None):
+    """
+    an AccessLog for the [access_log] section of a configfile.Config, None
+    when the section or its file key is missing. Raises ValueError for
+    bad values.
+    """
+    if not 'access_log' in config or not config.access_log.get('file'):
+        return None
+    alcfg = config.access_log
+    return AccessLog(alcfg.file,
+                     log_format=alcfg.get('log_format', 'common'),
+                     buffer_size=int(alcfg.get('buffer_size', 65536)),
+                     flush_interval=float(alcfg.get('flush_interval', 1.0)),
+                     max_bytes=int(alcfg.get('max_bytes', 0)),
+                     backups=int(alcfg.get('backups', 5)),
+                     sample=float(alcfg.get('sample', 1.0)),
+                     log=log)
+
+def check_config(filename=None):
+    """ build the access log from filename's [access_log] section, or SAMPLE_CONFIG """
+    from plugincore import configfile
+    if filename is None:
+        with tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False) as f:
+            f.write(SAMPLE_CONFIG)
+        try:
+            config = configfile.Config(file=f.name)
+        finally:
+            os.unlink(f.name)
+    else:
+        config = configfile.Config(file=filename)
+    alog = from_config(config)
+    if alog is None:
+        raise ValueError("no [access_log] section with a file key")
+    try:
+        return {'file': alog.path, 'log_format': alog.log_format, 'buffer_size': alog.buffer_size,
+                'flush_interval': alog.flush_interval, 'max_bytes': alog.max_bytes,
+                'backups': alog.backups, 'sample': alog.sample}
+    finally:
+        alog.close()
+
+if __name__ == '__main__':
+    settings = check_config(sys.argv[1] if len(sys.argv) > 1 else None)
+    for key, value in settings.items():
+        print(f"{key:>15} {value}")
@@ -2,13 +2,28 @@ import asyncio
 from aiohttp import web
 import inspect
 from plugincore import logjam
+from plugincore import jsoncodec
+from plugincore import accesslog
+from plugincore.context import RequestContext, client_ip
 
 class BasePlugin:
     """
     This is the base class for plugincore plugins. 
     The constructor handles setting up the instance variables so the 
     plugin can play nicely with the plugin manager.
+
+    Set request_context = True in a subclass to have request_handler called
+    with a single RequestContext instead of **data.
+
+    Set cache_ttl (seconds) to have GET responses served from the server's
+    response cache. cache_query_keys names the query variables that make up
+    the cache key; None means all of them except apikey. Both can also be set
+    with plugin_parms, e.g. systeminfo=cache_ttl=2&cache_keys=a,b
     """
+    request_context = False
+    cache_ttl = 0
+    cache_query_keys = None
+
     def __init__(self, **kwargs):
         self._auth_type = None
         self._apikey = None
@@ -36,18 +51,16 @@ class BasePlugin:
             self.log = logjam.LogJam(file=args.log, name=self._plugin_id,level=args.level)
         else:
             self.log = logjam.LogJam(name=self._plugin_id,level=args.level)
+        self._response_cache = kwargs.get('response_cache')
+        if kwargs.get('cache_ttl') is not None:
+            self.cache_ttl = float(kwargs.get('cache_ttl'))
+        if kwargs.get('cache_keys'):
+            self.cache_query_keys = tuple(k.strip() for k in kwargs.get('cache_keys').split(',') if k.strip())
         kwargs['log'] = self.log
         self.args = dict(kwargs)
 
     def _get_client_ip(self,request):
-        # Check proxy headers first
-        forwarded_for = request.headers.get('X-Forwarded-For')
-        if forwarded_for:
-            return forwarded_for.split(',')[0].strip()
-
-        # Fall back to transport address
-        peername = request.transport.get_extra_info('peername')
-        return peername[0] if peername else 'unknown'
+        return client_ip(request)
 
     def terminate_plugin(self):
         pass
@@ -92,27 +105,100 @@ class BasePlugin:
         #print("returning default true")
         return True
 
+    async def _stream_response(self, request, code, chunks, content_type=None):
+        """
+        Write the items of an async iterable to the client as they are produced,
+        using chunked transfer encoding. If the first item is a dict or list the
+        items are written as NDJSON, one JSON document per line, otherwise str
+        and bytes items are written as they are. Each write waits for the
+        transport to drain so only one item is held in memory at a time.
+        """
+        response = web.StreamResponse(status=code)
+        response.enable_chunked_encoding()
+        response[accesslog.PAYLOAD_BYTES] = 0
+        iterator = chunks.__aiter__()
+        try:
+            try:
+                item = await iterator.__anext__()
+                more = True
+            except StopAsyncIteration:
+                item, more = None, False
+            ndjson = isinstance(item, (dict, list))
+            if content_type:
+                response.content_type = content_type
+            elif ndjson:
+                response.content_type = 'application/x-ndjson'
+            elif isinstance(item, (bytes, bytearray)):
+                response.content_type = 'application/octet-stream'
+            else:
+                response.content_type = 'text/plain'
+            await response.prepare(request)
+            while more:
+                if ndjson:
+                    item = jsoncodec.dumpb(item) + b'\n'
+                if isinstance(item, str):
+                    item = item.encode('utf-8')
+                if item:
+                    await response.write(item)
+                    response[accesslog.PAYLOAD_BYTES] += len(item)
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    more = False
+            await response.write_eof()
+        except Exception as e:
+            self.log.error(f"{self._plugin_id}: stream aborted after {response.body_length} bytes: {type(e).__name__}: {e}")
+            raise
+        finally:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose:
+                await aclose()
+        return response
+
     def _get_plugin_id(self):
         return self._plugin_id
     
-    async def handle_request(self, **data):
-        request = data.get('request',{})
-        auth_check = self._check_auth(data)
-        data['client_ip'] = self._get_client_ip(data.get('request'))
-        if auth_check:
-            result = self.request_handler(**data)
-            code, response = await result if inspect.isawaitable(result) else result
-            #print(f"Got {code} - {response}")
+    async def handle_request(self, ctx=None, **data):
+        if isinstance(ctx, RequestContext):
+            if self._auth_type and not (ctx.headers.get('Authorization') or ctx.headers.get('X-Custom-Auth')):
+                await ctx.json()    # the apikey can only be in the body now
+            data = ctx if self.request_context else await ctx.as_dict()
+        else:
+            data['client_ip'] = self._get_client_ip(data.get('request'))
+        if not self._check_auth(data):
+            self.log.error(f"{data.get('client_ip')} - request for {self._plugin_id} - Not authorized")
+            return await self._make_response(data, 403, {'error': 'unauthorized'})
+        request = data.get('request')
+        if self.cache_ttl and self._response_cache is not None and request is not None and request.method == 'GET':
+            return await self._response_cache.fetch(self._cache_key(request, data), self.cache_ttl,
+                                                    lambda: self._respond(data))
+        return await self._respond(data)
+
+    def _cache_key(self, request, data):
+        query = request.query
+        if self.cache_query_keys is None:
+            params = tuple(sorted((k, v) for k, v in query.items() if k != 'apikey'))
         else:
-            self.log.error(f"{data['client_ip']} - request for {self._plugin_id} - Not authorized")
-            code, response = 403, {'error': 'unauthorized'}
+            params = tuple((k, query.get(k)) for k in self.cache_query_keys)
+        return (request.method, self._plugin_id, data.get('subpath'), params)
+
+    async def _respond(self, data):
+        if isinstance(data, RequestContext):
+            result = self.request_handler(data)
+        else:
+            result = self.request_handler(**data)
+        code, response = await result if inspect.isawaitable(result) else result
+        return await self._make_response(data, code, response)
 
-        if isinstance(response, web.Response):
+    async def _make_response(self, data, code, response):
+        if hasattr(response, '__aiter__'):
+            response = await self._stream_response(data.get('request'), code, response)
+        elif isinstance(response, web.StreamResponse):
             pass
         elif isinstance(response, dict):
-            response = web.json_response(response)
+            response = jsoncodec.json_response(response)
         elif isinstance(response, str):
             response = web.Response(text=response, content_type='text/html')
         else:
-            response = web.json_response({'result': str(response)})
+            response = jsoncodec.json_response({'result': str(response)})
         return response
@@ -0,0 +1,121 @@
+"""
+Request context handed to plugins.
+
+RequestContext wraps an aiohttp request without copying anything out of it.
+Headers and query are the request's own read-only views, the client address
+is worked out on first use and the JSON body is only read and parsed when
+something asks for it.
+"""
+from plugincore import jsoncodec
+
+def client_ip(request):
+    """ get the client address, preferring proxy headers over the transport """
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+    transport = request.transport
+    peername = transport.get_extra_info('peername') if transport else None
+    return peername[0] if peername else 'unknown'
+
+class RequestContext:
+    """
+    A lazy, read-only view of a request.
+
+    For plugins that still take **data, as_dict() builds the same dict the
+    server used to build. The context also answers get(), [] and `in` for the
+    keys of that dict, so code written against data keeps working when handed
+    a context.
+    """
+    __slots__ = ('request', 'subpath', 'log', '_body', '_client_ip')
+
+    def __init__(self, request, subpath=None, log=None):
+        self.request = request
+        self.subpath = subpath
+        self.log = log
+        self._body = None
+        self._client_ip = None
+
+    @property
+    def headers(self):
+        return self.request.headers
+
+    @property
+    def query(self):
+        return self.request.query
+
+    @property
+    def method(self):
+        return self.request.method
+
+    @property
+    def cookies(self):
+        return self.request.cookies
+
+    @property
+    def client_ip(self):
+        if self._client_ip is None:
+            self._client_ip = client_ip(self.request)
+        return self._client_ip
+
+    @property
+    def body_read(self):
+        return self._body is not None
+
+    async def json(self):
+        """
+        return the parsed JSON body of a POST, reading it on the first call.
+        Returns {} when there is no body or it isn't valid JSON.
+        """
+        if self._body is None:
+            body = {}
+            if self.request.method == 'POST' and self.request.can_read_body:
+                try:
+                    body = await self.request.json(loads=jsoncodec.loads)
+                except Exception as e:
+                    if self.log:
+                        self.log.exception(f"Cannot get request body: {e}")
+            self._body = body
+        return self._body
+
+    async def as_dict(self):
+        """ build the legacy **data dict: body, then query, then subpath and client_ip """
+        data = {'log': self.log, 'request_headers': self.headers, 'request': self.request}
+        body = await self.json()
+        if isinstance(body, dict):
+            data.update(body)
+        data.update(self.query)
+        data['subpath'] = self.subpath
+        data['client_ip'] = self.client_ip
+        return data
+
+    def __getitem__(self, key):
+        if key == 'request':
+            return self.request
+        if key == 'request_headers':
+            return self.headers
+        if key == 'subpath':
+            return self.subpath
+        if key == 'client_ip':
+            return self.client_ip
+        if key == 'log':
+            return self.log
+        query = self.request.query
+        if key in query:
+            return query[key]
+        if isinstance(self._body, dict) and key in self._body:
+            return self._body[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """ look up key as the legacy data dict would; the body is only searched once read """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
@@ -0,0 +1,45 @@
+"""
+Plugin dispatch table for pserv.
+
+Rather than registering GET and POST routes, with and without a tail, for
+every plugin, pserv registers one catch-all route and resolves the plugin with
+a single dict lookup on the first path segment. Whatever follows that segment
+is handed to the plugin as subpath.
+"""
+
+class PluginDispatcher:
+    """
+    Map the first segment of a request path to a plugin instance.
+
+    The table is never modified in place. rebuild() builds a new dict and swaps
+    it in with one assignment, so a request in flight while plugins are being
+    reloaded sees either the old table or the new one, never a partial one.
+    """
+    __slots__ = ('_table',)
+
+    def __init__(self, plugins=None):
+        self._table = dict(plugins or {})
+
+    def rebuild(self, plugins):
+        """ replace the table with a snapshot of plugins (plugin_id -> instance) """
+        self._table = dict(plugins)
+
+    def resolve(self, path):
+        """
+        resolve path to (plugin_id, plugin, subpath). plugin is None if no
+        plugin is registered for the first segment. subpath is None when the
+        path has no segments after the plugin id, as with /plugin_id.
+        """
+        if path.startswith('/'):
+            path = path[1:]
+        plugin_id, sep, subpath = path.partition('/')
+        return plugin_id, self._table.get(plugin_id), (subpath if sep else None)
+
+    def plugin_ids(self):
+        return list(self._table.keys())
+
+    def __contains__(self, plugin_id):
+        return plugin_id in self._table
+
+    def __len__(self):
+        return len(self._table)
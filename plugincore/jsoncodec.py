@@ -0,0 +1,90 @@
+"""
+JSON codec shared by the server, BasePlugin and the bundled plugins.
+
+The codec is chosen with json= in the [server] section of the config file:
+
+    [server]
+    json=orjson
+
+orjson, ujson and stdlib are supported. If the chosen library can't be
+imported the stdlib json module is used. Callers must look the functions up
+on the module at call time (jsoncodec.dumps(...)) so a codec switch is seen.
+
+    dumps(obj) -> str
+    dumpb(obj) -> bytes
+    loads(str|bytes) -> object
+"""
+import json
+from aiohttp import web
+
+CODECS = ('orjson', 'ujson', 'stdlib')
+
+name = 'stdlib'
+
+def _stdlib_dumpb(obj):
+    return json.dumps(obj).encode('utf-8')
+
+dumps = json.dumps
+dumpb = _stdlib_dumpb
+loads = json.loads
+
+def _orjson():
+    import orjson
+    option = orjson.OPT_NON_STR_KEYS
+
+    def default(obj):
+        # orjson doesn't serialize namedtuples (psutil returns plenty of them),
+        # stdlib json writes them as lists
+        if isinstance(obj, tuple):
+            return list(obj)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def _dumpb(obj):
+        return orjson.dumps(obj, default=default, option=option)
+
+    def _dumps(obj):
+        return _dumpb(obj).decode('utf-8')
+
+    return _dumps, _dumpb, orjson.loads
+
+def _ujson():
+    import ujson
+
+    def _dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    def _dumpb(obj):
+        return _dumps(obj).encode('utf-8')
+
+    return _dumps, _dumpb, ujson.loads
+
+def _stdlib():
+    return json.dumps, _stdlib_dumpb, json.loads
+
+_loaders = {'orjson': _orjson, 'ujson': _ujson, 'stdlib': _stdlib}
+
+def use(codec, log=None):
+    """
+    switch to codec, falling back to stdlib if it is unknown or not installed.
+    Returns the name of the codec in use.
+    """
+    global name, dumps, dumpb, loads
+    codec = (codec or 'stdlib').lower()
+    if codec not in _loaders:
+        if log:
+            log.error(f"Unknown json codec {codec}, using stdlib")
+        codec = 'stdlib'
+    try:
+        functions = _loaders[codec]()
+    except ImportError:
+        if log:
+            log.warn(f"json codec {codec} is not installed, using stdlib")
+        codec = 'stdlib'
+        functions = _stdlib()
+    dumps, dumpb, loads = functions
+    name = codec
+    return name
+
+def json_response(data, *, status=200, **kwargs):
+    """ like web.json_response, but encoded straight to bytes with the current codec """
+    return web.Response(body=dumpb(data), status=status, content_type='application/json', **kwargs)
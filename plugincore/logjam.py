@@ -1,5 +1,9 @@
 import sys
 import os
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
 # Standard Systemd/Syslog Priority Mapping
 
@@ -26,6 +30,184 @@ def os_print(output):
         os.write(1,output.encode('utf-8'))
     except BrokenPipeError:
         pass
+
+STDOUT = '-'
+RAW_FORMAT = '{msg}'
+
+# Writer settings, see configure()
+_settings = {
+    'queued': False,        # write from a background thread
+    'queue_size': 10000,    # records held before the overflow policy applies
+    'overflow': 'drop',     # drop or block when the queue is full
+    'batch': 512,           # most records written per batch
+}
+_sinks = {}                 # destination -> sink, shared by every LogJam
+_sinks_lock = threading.Lock()
+
+def _message(fmt, args):
+    """
+    Build the message text for a debugf() record. Called only after the level
+    check, so the arguments are not rendered for records that won't be written:
+        log.debugf("%s: %d rows", name, n)  -> "%s: %d rows" % (name, n)
+    A format that doesn't match its arguments is written as debug() would.
+    """
+    try:
+        return fmt % args
+    except (TypeError, ValueError):
+        return ' '.join(map(str, (fmt,) + args))
+
+def _render(fmt, record):
+    created, priority, name, level, msg = record
+    if fmt == RAW_FORMAT:
+        return msg
+    timestamp = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
+    return fmt.format(timestamp=timestamp, priority=priority, name=name, level=level, msg=msg)
+
+class _Sink:
+    """
+    Writes formatted records to one destination, a file or stdout. There is
+    one sink per destination no matter how many LogJam instances use it.
+    """
+    def __init__(self, dest):
+        self.dest = dest
+        self.lock = threading.Lock()
+        self.fh = None if dest == STDOUT else open(dest, 'a')
+
+    def _write(self, text):
+        if self.fh:
+            self.fh.write(text)
+            self.fh.flush()
+        else:
+            data = text.encode('utf-8')
+            try:
+                while data:
+                    data = data[os.write(1, data):]
+            except BrokenPipeError:
+                pass
+
+    def emit(self, fmt, record):
+        with self.lock:
+            self._write(_render(fmt, record) + '\n')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+
+class _QueuedSink(_Sink):
+    """
+    A sink that hands records to a background thread through a bounded queue.
+    The thread formats them and writes whatever has queued up in one write.
+    """
+    def __init__(self, dest, queue_size, overflow, batch):
+        super().__init__(dest)
+        self.queue = queue.Queue(queue_size)
+        self.block = overflow == 'block'
+        self.batch = batch
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name=f"logjam:{dest}", daemon=True)
+        self.thread.start()
+
+    def emit(self, fmt, record):
+        if self.block:
+            self.queue.put((fmt, record))
+            return
+        try:
+            self.queue.put_nowait((fmt, record))
+        except queue.Full:
+            # emitted from any thread, reset by the writer thread
+            with self.lock:
+                self.dropped += 1
+
+    def _run(self):
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is None:
+                    running = False
+                else:
+                    lines.append(_render(*item))
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(_render("{timestamp} - {name} - {level} - {msg}",
+                                     (time.time(), 4, 'logjam', 'WARN', f"log queue full, dropped {dropped} records")))
+            if lines:
+                lines.append('')
+                try:
+                    self._write('\n'.join(lines))
+                except Exception:
+                    pass
+            for _ in items:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(5)
+        super().close()
+
+def _new_sink(dest):
+    if _settings['queued']:
+        return _QueuedSink(dest, _settings['queue_size'], _settings['overflow'], _settings['batch'])
+    return _Sink(dest)
+
+def _get_sink(dest):
+    sink = _sinks.get(dest)
+    if sink is None:
+        with _sinks_lock:
+            sink = _sinks.get(dest)
+            if sink is None:
+                sink = _sinks[dest] = _new_sink(dest)
+    return sink
+
+def configure(*, queued=None, queue_size=None, overflow=None, batch=None):
+    """
+    Set how log records are written. With queued=True every destination gets a
+    writer thread fed by a bounded queue so logging never blocks the caller on
+    I/O; overflow decides what happens when the queue is full, 'drop' (the
+    default, dropped records are counted and reported) or 'block'. Existing
+    destinations are switched over straight away.
+    """
+    if overflow is not None and overflow not in ('drop', 'block'):
+        raise ValueError(f"overflow must be drop or block, not {overflow}")
+    for key, value in (('queued', queued), ('queue_size', queue_size), ('overflow', overflow), ('batch', batch)):
+        if value is not None:
+            _settings[key] = value
+    with _sinks_lock:
+        old = list(_sinks.items())
+        for dest, sink in old:
+            _sinks[dest] = _new_sink(dest)
+    for dest, sink in old:
+        sink.close()
+
+def flush():
+    """ wait until every queued record has been written """
+    for sink in list(_sinks.values()):
+        sink.flush()
+
+def shutdown():
+    """ flush and close all destinations, later records are written synchronously """
+    _settings['queued'] = False
+    with _sinks_lock:
+        old = list(_sinks.values())
+        _sinks.clear()
+    for sink in old:
+        sink.close()
+
+atexit.register(shutdown)
+
 class LogJam:
     def __init__(self, *, name=None, level="INFO",file=None, stdio=True):
         self.stdio = stdio
@@ -44,7 +226,9 @@ class LogJam:
 
         self.file = file
         if self.file:
-            self.logfile = open(self.file,'a')
+            # destinations are shared, every LogJam on the same file uses one handle
+            self.logfile = os.path.abspath(os.path.expanduser(self.file))
+            _get_sink(self.logfile)
         else:
             self.logfile = None
         if not name:
@@ -55,33 +239,63 @@ class LogJam:
         self.sysd_format = "<{priority}> - {level} - {name} - {msg}"
         self.std_format = "{timestamp} - {name} - {level} - {msg}"
 
+    def common_log(self, **kwargs):
+        """
+        Format a Common Log Format line and, if file is given, append it to that
+        file through the shared writer for it. Returns the line.
+        Required: ip, method, path, protocol, status, size
+        Optional: user_ident, user_auth, timestamp, file
+        """
+        bad_keys = [k for k in ['ip','method','protocol','path','status','size'] if kwargs.get(k) is None]
+        if len(bad_keys):
+            raise AttributeError(f"No value(s) given for {' '.join(bad_keys)}")
+        timestamp = kwargs.get('timestamp') or time.time()
+        time_str = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(timestamp))
+        lstr = (f'{kwargs["ip"]} {kwargs.get("user_ident","-")} {kwargs.get("user_auth","-")} [{time_str}] '
+                f'"{kwargs["method"]} {kwargs["path"]} {kwargs["protocol"]}" {kwargs["status"]} {kwargs["size"]}')
+        file = kwargs.get('file')
+        if file:
+            _get_sink(os.path.abspath(os.path.expanduser(file))).emit(RAW_FORMAT, (timestamp, 0, self.name, 'INFO', lstr))
+        return lstr
+
+    def isEnabledFor(self, level):
+        """
+        True if a record at level (a name such as "DEBUG", or a number) would
+        be written. Use it to guard work done only to build a log message.
+        """
+        if isinstance(level, str):
+            level = self.levels.get(level.upper(), 20)
+        return level >= self.threshold
+
     def _output(self, level, *args):
         if self.levels[level] >= self.threshold:
-            msgargs = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3],
-                "priority": LOG_PRIORITIES[self.levels[level]],
-                "name": self.name, 
-                "level": level,
-                "msg": ' '.join(map(str, args))
-            }
-            # if an output file was specified write there 
-            if self.logfile:
-                print(self.std_format.format(**msgargs),file=self.logfile)
-                self.logfile.flush()
-            # if we're not writing stdout to a tty assume a pipe to systemd
-            if not self.tty:
-                os_print(self.sysd_format.format(**msgargs))
-            else:
-                ## If stdout is a tty and stdio is true write to stdout 
-                if self.stdio:
-                    os_print(self.std_format.format(**msgargs))
+            self._emit(level, ' '.join(map(str, args)))
+
+    def _outputf(self, level, fmt, args):
+        if self.levels[level] >= self.threshold:
+            self._emit(level, _message(fmt, args))
+
+    def _emit(self, level, msg):
+        record = (time.time(), LOG_PRIORITIES[self.levels[level]], self.name, level, msg)
+        # if an output file was specified write there 
+        if self.logfile:
+            _get_sink(self.logfile).emit(self.std_format, record)
+        # if we're not writing stdout to a tty assume a pipe to systemd
+        if not self.tty:
+            _get_sink(STDOUT).emit(self.sysd_format, record)
+        else:
+            ## If stdout is a tty and stdio is true write to stdout 
+            if self.stdio:
+                _get_sink(STDOUT).emit(self.std_format, record)
 
     def __call__(self,*args):
         self._output("INFO",*args)
 
     def debug(self, *m): self._output("DEBUG", *m)
+    def debugf(self, fmt, *args): self._outputf("DEBUG", fmt, args)
     def info(self, *m):  self._output("INFO", *m)
     def warn(self, *m):  self._output("WARN", *m)
+    def warning(self, *m): self._output("WARN", *m)
     def error(self, *m): self._output("ERROR", *m)
     def critical(self, *m): self._output("CRITICAL", *m)
     def exception(self, *m): self._output("EXCEPTION", *m)
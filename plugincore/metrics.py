@@ -0,0 +1,144 @@
+"""
+Request metrics for pserv, served in the Prometheus text format by /metrics.
+
+Each process keeps its own counters; with --workers every worker answers
+/metrics for itself and labels its series with worker="<pid>". Everything is
+updated from the event loop thread, so the counters are plain integers and
+floats with no locking.
+"""
+import os
+import time
+import asyncio
+from bisect import bisect_left
+
+# request latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# event loop lag buckets, in seconds
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+SERVER = '_server'      # plugin label for requests that didn't go to a plugin
+CLIENT_CLOSED = 499     # status recorded for requests cancelled by a client disconnect
+
+class Histogram:
+    """ fixed bucket histogram, counts[-1] is the +Inf bucket """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class PluginStats:
+    __slots__ = ('requests', 'errors', 'in_flight', 'statuses', 'latency')
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.statuses = {}
+        self.latency = Histogram(buckets)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.worker = str(os.getpid())
+        self.started = time.time()
+        self.plugins = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.loop_lag_last = 0.0
+        self.loop_lag_max = 0.0
+        self._watcher = None
+
+    def begin(self, plugin_id):
+        """ count a request as in flight, returns the stats to hand to end() """
+        plugin_id = plugin_id or SERVER
+        stats = self.plugins.get(plugin_id)
+        if stats is None:
+            stats = self.plugins[plugin_id] = PluginStats(self.buckets)
+        stats.in_flight += 1
+        return stats
+
+    def end(self, stats, status, latency):
+        stats.in_flight -= 1
+        stats.requests += 1
+        if status >= 500:
+            stats.errors += 1
+        status_class = f"{status // 100}xx"
+        stats.statuses[status_class] = stats.statuses.get(status_class, 0) + 1
+        stats.latency.observe(latency)
+
+    def start(self, interval=0.5):
+        """ start measuring event loop lag, must be called with the loop running """
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch_loop(interval), name="metrics:loop_lag")
+
+    async def _watch_loop(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - before - interval)
+            self.loop_lag.observe(lag)
+            self.loop_lag_last = lag
+            if lag > self.loop_lag_max:
+                self.loop_lag_max = lag
+
+    def render(self, extra=None):
+        """
+        render all metrics in the Prometheus text format. extra maps metric
+        names to (type, help, value) for gauges/counters owned elsewhere.
+        """
+        worker = f'worker="{self.worker}"'
+        out = []
+
+        def header(name, mtype, text):
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {mtype}")
+
+        def histogram(name, labels, hist):
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                out.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            out.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+            out.append(f"{name}_sum{{{labels}}} {hist.sum}")
+            out.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        plugins = sorted(self.plugins.items())
+        header('pserv_requests_total', 'counter', 'Requests handled, by plugin and status class.')
+        for pid, stats in plugins:
+            for status_class, count in sorted(stats.statuses.items()):
+                out.append(f'pserv_requests_total{{{worker},plugin="{_label(pid)}",status="{status_class}"}} {count}')
+        header('pserv_request_errors_total', 'counter', 'Requests that ended with a 5xx status.')
+        for pid, stats in plugins:
+            out.append(f'pserv_request_errors_total{{{worker},plugin="{_label(pid)}"}} {stats.errors}')
+        header('pserv_requests_in_flight', 'gauge', 'Requests being handled right now.')
+        for pid, stats in plugins:
+            out.append(f'pserv_requests_in_flight{{{worker},plugin="{_label(pid)}"}} {stats.in_flight}')
+        header('pserv_request_duration_seconds', 'histogram', 'Time taken to produce a response.')
+        for pid, stats in plugins:
+            histogram('pserv_request_duration_seconds', f'{worker},plugin="{_label(pid)}"', stats.latency)
+
+        header('pserv_event_loop_lag_seconds', 'histogram', 'How late the event loop woke a sleeping task.')
+        histogram('pserv_event_loop_lag_seconds', worker, self.loop_lag)
+        header('pserv_event_loop_lag_max_seconds', 'gauge', 'Largest event loop lag seen.')
+        out.append(f"pserv_event_loop_lag_max_seconds{{{worker}}} {self.loop_lag_max}")
+        header('pserv_tasks', 'gauge', 'asyncio tasks that have not finished.')
+        out.append(f"pserv_tasks{{{worker}}} {len(asyncio.all_tasks())}")
+        header('pserv_uptime_seconds', 'gauge', 'Seconds since this process started serving.')
+        out.append(f"pserv_uptime_seconds{{{worker}}} {round(time.time() - self.started, 3)}")
+
+        for name, (mtype, text, value) in (extra or {}).items():
+            header(name, mtype, text)
+            out.append(f"{name}{{{worker}}} {value}")
+        out.append('')
+        return '\n'.join(out)
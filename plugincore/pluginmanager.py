@@ -9,6 +9,24 @@ from plugincore import baseplugin
 from urllib.parse import parse_qs
 import json
 
+# sys.modules package the plugin modules are registered under
+PLUGIN_NAMESPACE = 'pserv_plugins'
+
+def plugin_namespace(plugin_dir):
+    """
+    register the PLUGIN_NAMESPACE package for plugin_dir. Also a process
+    pool initializer, so spawned workers can import plugin modules by name.
+    """
+    namespace = sys.modules.get(PLUGIN_NAMESPACE)
+    if namespace is None:
+        namespace = types.ModuleType(PLUGIN_NAMESPACE)
+        namespace.__path__ = []
+        sys.modules[PLUGIN_NAMESPACE] = namespace
+    plugin_dir = os.path.abspath(plugin_dir)
+    if plugin_dir not in namespace.__path__:
+        namespace.__path__.append(plugin_dir)
+    return namespace
+
 def parse_parameter_string(s):
     return {key: value[0] for key, value in parse_qs(s).items()}
 
@@ -30,12 +48,22 @@ class PluginManager:
         self.config = config
 
     async def _load_module(self, filepath: str) -> types.ModuleType:
-        mod_name = os.path.basename(filepath).replace(".py", "")
+        # plugins live in their own namespace so a plugin named like a stdlib
+        # or installed module (json, queue...) can't shadow or replace it
+        mod_name = f"{PLUGIN_NAMESPACE}.{os.path.basename(filepath).replace('.py', '')}"
+        plugin_namespace(os.path.dirname(filepath))
         spec = importlib.util.spec_from_file_location(mod_name, filepath)
         if spec is None or spec.loader is None:
             raise ImportError(f"Cannot load module from {filepath}")
         mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)
+        # registered so functions defined in plugins can be pickled, e.g. to
+        # hand them to a process pool; remove_plugin takes it out again
+        sys.modules[mod_name] = mod
+        try:
+            spec.loader.exec_module(mod)
+        except BaseException:
+            sys.modules.pop(mod_name, None)
+            raise
         return mod
 
     def _get_plugin_classes(self, mod: types.ModuleType) -> List[baseplugin.BasePlugin]:
@@ -92,14 +120,15 @@ class PluginManager:
 
         # Try to remove the module
         try:
-            plugin.terminate_plugin()
+            result = plugin.terminate_plugin()
+            if inspect.isawaitable(result):
+                await result
         except Exception as e:
             self.log.exception(f"Exception {type(e)} Unloading plugin - terminate_plugin threw {e}")
         module_name = plugin.__class__.__module__
-        module_file = os.path.basename(module_name + ".py")
         self.log(f"Removing plugin {plugin_id} from module {module_name}")
 
-        self.modules.pop(module_file, None)
+        self.modules.pop(module_name.rpartition('.')[2], None)
         sys.modules.pop(module_name, None)
 
     async def reload_plugin(self, plugin_id: str):
@@ -108,7 +137,7 @@ class PluginManager:
             return
         plugin = self.plugins[plugin_id]
         module_name = plugin.__class__.__module__
-        module_file = os.path.basename(module_name + ".py")
+        module_file = module_name.rpartition('.')[2] + ".py"
         full_path = os.path.join(self.plugin_dir, module_file)
 
         await self.remove_plugin(plugin_id)
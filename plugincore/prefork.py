@@ -0,0 +1,250 @@
+"""
+Pre-fork worker supervisor for pserv.
+
+The supervisor owns the listening socket (or, with reuse_port, lets each worker
+bind its own SO_REUSEPORT socket), forks the configured number of workers and
+keeps them running. Each worker runs its own event loop and PluginManager.
+
+Signals handled by the supervisor:
+    SIGUSR1         rolling reload: one worker at a time is sent SIGUSR1, stops
+                    accepting, exits cleanly and is re-forked with fresh plugins
+                    and config. The next worker is signalled once the new one
+                    has called notify_ready(), so the others keep serving.
+    SIGTERM/SIGINT  SIGTERM is sent to every worker, then the supervisor exits
+                    once they have all gone away. Workers ignore SIGINT, so a
+                    Ctrl-C to the process group stops them cleanly too.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+
+# A worker that dies sooner than this after being forked is considered to be
+# crash-looping and is re-forked after a short back off.
+MIN_WORKER_UPTIME = 1.0
+RESPAWN_BACKOFF = 1.0
+STOP_TIMEOUT = 10.0
+# a rolling reload moves on to the next worker after this long even if the
+# replacement never reported that it is ready
+READY_TIMEOUT = 30.0
+
+_ready_fd = None    # in a worker, the pipe the supervisor waits on
+
+def notify_ready():
+    """ called by a worker once it is accepting connections; a no-op outside the supervisor """
+    global _ready_fd
+    if _ready_fd is None:
+        return
+    try:
+        os.write(_ready_fd, b'r')
+        os.close(_ready_fd)
+    except OSError:
+        pass
+    _ready_fd = None
+
+def listen_socket(host, port, reuse_port=False, backlog=128):
+    """
+    create, bind and listen on a TCP socket suitable for sharing between workers
+    """
+    family = socket.AF_INET6 if host and ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+class Supervisor:
+    """
+    Fork and supervise pserv workers.
+
+    target is called in each worker with the listening socket and must return
+    the worker's exit code.
+    """
+    def __init__(self, *, workers, bindto, port, target, log, reuse_port=False):
+        if workers < 1:
+            raise ValueError("workers must be 1 or more")
+        self.workers = workers
+        self.bindto = bindto
+        self.port = port
+        self.target = target
+        self.log = log
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        if reuse_port and not self.reuse_port:
+            self.log.warn("SO_REUSEPORT is not available, using an inherited socket")
+        self.sock = None
+        self.children = {}      # pid -> (slot, start time)
+        self.ready_pipes = {}   # pid -> read end of its notify_ready() pipe
+        self.ready = set()      # pids that have called notify_ready()
+        self.reload_queue = []  # pids still to be reloaded, one at a time
+        self.reloading = None   # pid told to reload, until it has gone
+        self.running = False
+        self.pending = []       # signals received, acted on in the main loop
+
+    def _on_signal(self, signum, frame):
+        self.pending.append(signum)
+
+    def _spawn(self, slot):
+        global _ready_fd
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(wfd)
+            os.set_blocking(rfd, False)
+            self.children[pid] = (slot, time.monotonic())
+            self.ready_pipes[pid] = rfd
+            self.log(f"Started worker {slot} pid {pid}")
+            return pid
+        # worker
+        code = 1
+        try:
+            os.close(rfd)
+            for fd in self.ready_pipes.values():
+                os.close(fd)
+            _ready_fd = wfd
+            for sig in (signal.SIGUSR1, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            # a Ctrl-C reaches the whole process group; the supervisor turns it
+            # into a SIGTERM, which lets the worker terminate its plugins first
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            sock = self.sock
+            if self.reuse_port:
+                sock = listen_socket(self.bindto, self.port, reuse_port=True)
+            code = self.target(sock) or 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            self.log.exception(f"worker {slot}({os.getpid()}): {type(e).__name__}: {e}")
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _signal_workers(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        """ collect exited workers, returns a list of freed slots """
+        freed = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            slot, started = self.children.pop(pid, (None, 0))
+            self._forget(pid)
+            if slot is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            self.log(f"Worker {slot} pid {pid} exited with {code}")
+            freed.append((slot, time.monotonic() - started))
+        return freed
+
+    def _forget(self, pid):
+        fd = self.ready_pipes.pop(pid, None)
+        if fd is not None:
+            os.close(fd)
+        self.ready.discard(pid)
+
+    def _poll_ready(self):
+        for pid, fd in list(self.ready_pipes.items()):
+            try:
+                data = os.read(fd, 1)
+            except BlockingIOError:
+                continue
+            if data:
+                self.ready.add(pid)
+            os.close(fd)
+            del self.ready_pipes[pid]
+
+    def _settled(self):
+        """ every worker is up: ready, or started long enough ago to stop waiting for it """
+        now = time.monotonic()
+        return all(pid in self.ready or now - started > READY_TIMEOUT
+                   for pid, (_, started) in self.children.items())
+
+    def _reload_next(self):
+        """ signal the next worker of a rolling reload once the previous one has been replaced """
+        if self.reloading in self.children:
+            return
+        self.reloading = None
+        self._poll_ready()
+        if not self._settled():
+            return
+        while self.reload_queue:
+            pid = self.reload_queue.pop(0)
+            if pid not in self.children:
+                continue
+            slot = self.children[pid][0]
+            self.log(f"Reloading worker {slot} pid {pid}")
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                continue
+            self.reloading = pid
+            return
+
+    def _stop(self):
+        self.log("Stopping workers")
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        if self.children:
+            self.log.warn(f"Killing {len(self.children)} worker(s) that did not stop")
+            self._signal_workers(signal.SIGKILL)
+            while self.children:
+                try:
+                    pid, _ = os.waitpid(-1, 0)
+                except ChildProcessError:
+                    break
+                self.children.pop(pid, None)
+
+    def run(self):
+        """ fork the workers and supervise them until told to stop """
+        if not self.reuse_port:
+            self.sock = listen_socket(self.bindto, self.port)
+        self.log(f"Supervisor {os.getpid()} starting {self.workers} workers on {self.bindto}:{self.port}"
+                 f"{' (SO_REUSEPORT)' if self.reuse_port else ''}")
+        for sig in (signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_signal)
+        self.running = True
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        try:
+            while self.running:
+                while self.pending:
+                    signum = self.pending.pop(0)
+                    if signum == signal.SIGUSR1:
+                        self.log("Reload requested, reloading workers one at a time")
+                        self.reload_queue = [pid for pid in self.children if pid != self.reloading]
+                    else:
+                        self.log(f"Received {signal.Signals(signum).name}, shutting down")
+                        self.running = False
+                if not self.running:
+                    break
+                for slot, uptime in self._reap():
+                    if uptime < MIN_WORKER_UPTIME:
+                        time.sleep(RESPAWN_BACKOFF)
+                    self._spawn(slot)
+                self._reload_next()
+                time.sleep(0.2)
+        finally:
+            self._stop()
+            for pid in list(self.ready_pipes):
+                self._forget(pid)
+            if self.sock:
+                self.sock.close()
+        return 0
@@ -6,16 +6,30 @@ import ssl
 import os
 import sys
 import signal
+import time
 import aiohttp_cors
 from aiohttp import web
 from plugincore import pluginmanager
 from plugincore import configfile
 from plugincore import logjam
+from plugincore import prefork
+from plugincore import dispatcher
+from plugincore import jsoncodec
+from plugincore import respcache
+from plugincore import accesslog
+from plugincore import metrics
+from plugincore.context import RequestContext, client_ip
 import traceback
 routes = web.RouteTableDef()
 manager = None
+plugin_table = dispatcher.PluginDispatcher()
+response_cache = None
+access_log = None
+request_metrics = None
 globalCfg = None
 config_file = None
+worker_mode = False
+server_site = None
 
 async_tasks = []
 
@@ -63,7 +77,7 @@ async def on_shutdown(*args):
     global async_tasks
     global log
     global globalCfg
-    if 'pidfile' in globalCfg.paths:
+    if 'pidfile' in globalCfg.paths and not worker_mode:
         try:
             os.unlink(globalCfg.paths.pidfile)
         except:
@@ -71,11 +85,12 @@ async def on_shutdown(*args):
     if on_shutdown_entered:
         return
     on_shutdown_entered = True
+    await stop_listening()
     log(("Sending plugins the terminate signal"))
     for id, plugin in manager.plugins.items():
         try:
             log(f"Terminating plugin {id}")
-            plugin.terminate_plugin()
+            await maybe_async(plugin.terminate_plugin())
             await asyncio.sleep(1)
         except Exception as e:
             log(f"{type(e).__name__} Exception unloading plugin id {id}: {e}")
@@ -113,6 +128,31 @@ async def on_shutdown(*args):
     else:
         log("No other async tasks found to cancel.")
 
+def close_access_log():
+    """ write out and close the access log, once nothing more will be recorded """
+    if access_log:
+        access_log.close()
+
+async def on_cleanup(app):
+    # after on_shutdown, once aiohttp has finished the requests in flight
+    close_access_log()
+
+async def stop_listening():
+    """
+    stop accepting connections before the plugins go away, so new requests
+    go to the other workers (or wait for the restarted server) instead of
+    getting 404s from a server with no plugins
+    """
+    global server_site
+    site, server_site = server_site, None
+    if site is None:
+        return
+    try:
+        await site.stop()
+        log("Stopped accepting connections")
+    except Exception as e:
+        log.error(f"{type(e).__name__} closing the listener: {e}")
+
 async def _sh_then_act(action_func, *action_args):
     global log
     try:
@@ -144,25 +184,41 @@ def _sched_sh(async_wrapper_func, sync_action_func, *sync_action_args):
 
 def _act_execl():
     global log
+    close_access_log()
+    logjam.shutdown()
     sys.stdout.flush()
     sys.stderr.flush()
     os.execl(sys.executable, sys.executable, *sys.argv)
 
+def _act_worker_exit(exit_code):
+    close_access_log()
+    logjam.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
 def _act_exit(exit_code):
     globals()['_signal_exit_code'] = exit_code
+    close_access_log()
     try:
         asyncio.get_running_loop().stop()
     except RuntimeError:
         sys.exit(exit_code)
 
-async def pserve_main(args):
+async def pserve_main(args, sock=None):
     global log
     global manager
     global globalCfg
     global config_file
     global routes
     global on_shutdown
+    global worker_mode
+    global response_cache
+    global access_log
+    global request_metrics
+    global server_site
     asyncio.current_task().set_name("::main::")
+    worker_mode = sock is not None
 
     we_are = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -172,7 +228,12 @@ async def pserve_main(args):
     else:
         log = logjam.LogJam(name=we_are)
 
-    signal.signal(signal.SIGUSR1, reload)
+    if worker_mode:
+        # the supervisor re-forks us on exit, which reloads plugins and config
+        signal.signal(signal.SIGUSR1, worker_reload)
+        signal.signal(signal.SIGTERM, worker_reload)
+    else:
+        signal.signal(signal.SIGUSR1, reload)
     log(f"{we_are}({os.getpid()}): Installed SIGUSR1 handler for reload.")
     for sig_val_item in []:
         try:
@@ -182,11 +243,13 @@ async def pserve_main(args):
             log(f"{type(e).__name__} setting signal handler for {sig_val_item}: {e}")
 
     globalCfg = configfile.Config(file=config_file)
-    if 'pidfile' in globalCfg.paths:
+    if 'pidfile' in globalCfg.paths and not worker_mode:
         with open(globalCfg.paths.pidfile,'w') as f:
             print(f"{os.getpid()}",file=f)
 
     globalCfg['logging']={'level': args.level}
+    configure_json(globalCfg)
+    configure_logging(globalCfg)
     ssl_ctx = None
     ssl_cert, ssl_key = (None, None)
     enabled = False
@@ -223,25 +286,42 @@ async def pserve_main(args):
         log(f"Configuration error: 'paths.plugins' not found in '{config_file}'. Cannot load plugins.")
         sys.exit(1)
     log("======== Loading plugin modules ========")
-    manager = pluginmanager.PluginManager(globalCfg.paths.plugins, config=globalCfg, log=log, task_callback=register_async_task, args=args)
+    server_cfg = globalCfg.get('server', {})
+    response_cache = respcache.ResponseCache(
+        max_entries=int(server_cfg.get('cache_entries', 1024)),
+        max_bytes=int(server_cfg.get('cache_bytes', 32 * 1024 * 1024)))
+    manager = pluginmanager.PluginManager(globalCfg.paths.plugins, config=globalCfg, log=log, task_callback=register_async_task,
+                                          response_cache=response_cache, args=args)
     await manager.load_plugins()
 
-    for plugin_id, instance in manager.plugins.items():
-        register_plugin_route(plugin_id, instance, globalCfg)
+    plugin_table.rebuild(manager.plugins)
+    for plugin_id in plugin_table.plugin_ids():
+        log(f"Registering route: /{plugin_id}")
 
     register_control_routes(globalCfg)
+    register_plugin_dispatch()
 
-    app = web.Application()
+    access_log = configure_access_log(globalCfg)
+    if configfile.value_bool(server_cfg.get('metrics', True)):
+        request_metrics = metrics.Metrics()
+        request_metrics.start()
+    app = web.Application(middlewares=[observe_request] if access_log or request_metrics else [])
     app.add_routes(routes)
     app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
     cors_setup(app)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, host=globalCfg.network.bindto, port=globalCfg.network.port, ssl_context=ssl_ctx)
+    if sock is not None:
+        site = web.SockSite(runner, sock, ssl_context=ssl_ctx)
+    else:
+        site = web.TCPSite(runner, host=globalCfg.network.bindto, port=globalCfg.network.port, ssl_context=ssl_ctx)
 
     try:
         await site.start()
+        server_site = site
         log(f"Server started on {globalCfg.network.bindto}:{globalCfg.network.port}")
+        prefork.notify_ready()
         await asyncio.Event().wait()
     except OSError as e:
         log.error(e)
@@ -254,6 +334,76 @@ async def pserve_main(args):
     finally:
         await runner.cleanup()
 
+def configure_logging(config):
+    global log
+    server_cfg = config.get('server', {})
+    if configfile.value_bool(server_cfg.get('log_async', False)):
+        overflow = server_cfg.get('log_overflow', 'drop')
+        logjam.configure(queued=True,
+                         queue_size=int(server_cfg.get('log_queue_size', 10000)),
+                         overflow=overflow)
+        log(f"Logging through background writers, overflow policy {overflow}")
+
+def configure_access_log(config):
+    global log
+    try:
+        alog = accesslog.from_config(config, log=log)
+    except ValueError as e:
+        log.error(f"Access log not enabled: {e}")
+        return None
+    if alog is None:
+        return None
+    alog.start()
+    log(f"Access log {alog.path} ({alog.log_format})")
+    return alog
+
+@web.middleware
+async def observe_request(request, handler):
+    """ time each request for the metrics and record it in the access log """
+    start = time.perf_counter()
+    pid, plugin, _ = plugin_table.resolve(request.path)
+    if plugin is None:
+        pid = None
+    stats = request_metrics.begin(pid) if request_metrics else None
+    status, size = 500, None
+    try:
+        response = await handler(request)
+        status = response.status
+        # body_length of a prepared response counts the headers too, and a
+        # FileResponse has no length until it is sent after this returns
+        size = response.get(accesslog.PAYLOAD_BYTES)
+        if size is None and not response.prepared:
+            size = response.content_length
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # the client went away, it isn't a server error
+        status = metrics.CLIENT_CLOSED
+        raise
+    finally:
+        latency = time.perf_counter() - start
+        if stats is not None:
+            request_metrics.end(stats, status, latency)
+        if access_log:
+            access_log.record(
+                client_ip=client_ip(request),
+                method=request.method,
+                path=request.path_qs,
+                protocol=f"HTTP/{request.version.major}.{request.version.minor}",
+                status=status,
+                size=size,
+                plugin=pid,
+                latency=latency)
+
+def configure_json(config):
+    global log
+    codec = 'stdlib'
+    if 'server' in config and 'json' in config.server:
+        codec = config.server.json
+    log(f"Using {jsoncodec.use(codec, log=log)} json codec")
+
 def check_auth(data, config):
     toktype = 'Undefined'
     def get_token(data):
@@ -293,46 +443,32 @@ def check_auth(data, config):
     auth_ok = expected == provided
     return auth_ok
 
-def register_plugin_route(plugin_id, instance, config):
+def register_plugin_dispatch():
+    """
+    Register the catch-all plugin route. This must be registered after the
+    control routes so those are matched first.
+    """
     global log
-    global manager
     global routes
 
-    log(f"Registering route: /{plugin_id}")
+    @routes.route('GET', '/{path:.*}')
+    @routes.route('POST', '/{path:.*}')
+    async def handle(request):
+        pid, inst, subpath = plugin_table.resolve(request.match_info['path'])
+        if inst is None:
+            raise web.HTTPNotFound()
 
-    @routes.route('GET', f'/{plugin_id}')
-    @routes.route('GET', f'/{plugin_id}/{{tail:.*}}')
-    @routes.route('POST', f'/{plugin_id}')
-    @routes.route('POST', f'/{plugin_id}/{{tail:.*}}')
-    async def handle(request, inst=instance, pid=plugin_id, cfg=config):
-        plugin = await manager.get_plugin(pid)
-        if plugin is None:
-            log(f"Plugin {pid} not found for request.")
-            return web.json_response({"error": f"Plugin {pid} not found"}, status=404)
-
-        data = {'log': log, 'request_headers': dict(request.headers), 'request': request}
-        if request.method == 'POST' and request.can_read_body:
-            try:
-                rqj = await request.json()
-                data.update(rqj)
-            except Exception as e:
-                log.exception(f"Cannot get request body for plugin {pid}: {e}")
-        data.update(request.query)
-        try:
-            data['subpath'] = request.match_info.get('tail')
-        except KeyError:
-            data['subpath'] = None
-
-        response_data = await maybe_async(inst.handle_request(**data))
+        ctx = RequestContext(request, subpath=subpath, log=log)
+        response_data = await maybe_async(inst.handle_request(ctx))
 
         if not isinstance(response_data, web.StreamResponse):
             if isinstance(response_data, (dict, list)):
-                response = web.json_response(response_data)
+                response = jsoncodec.json_response(response_data)
             elif isinstance(response_data, str):
                 response = web.Response(text=response_data)
             else:
                 log(f"Plugin {pid} returned unexpected response type: {type(response_data)}")
-                response = web.json_response({"error": "Internal server error from plugin response"}, status=500)
+                response = jsoncodec.json_response({"error": "Internal server error from plugin response"}, status=500)
         else:
             response = response_data
         return response
@@ -348,33 +484,77 @@ def register_control_routes(config):
     @routes.route('GET','/plugins')
     @routes.route('POST','/plugins')
     async def plugin_list(request):
-        data = {}
-        if request.method == 'POST' and request.can_read_body:
-            try:
-                data.update(await request.json())
-            except Exception: pass
-        data.update(request.query)
-        data['request_headers'] = dict(request.headers)
-        if not check_auth(data, config):
-            return web.json_response({'error': 'unauthorized'}, status=403)
+        ctx = RequestContext(request)
+        await ctx.json()
+        if not check_auth(ctx, config):
+            return jsoncodec.json_response({'error': 'unauthorized'}, status=403)
         
         loaded_plugins = list(manager.plugins.keys()) if manager and manager.plugins else []
-        return web.json_response({'loaded_plugins': loaded_plugins})
+        return jsoncodec.json_response({'loaded_plugins': loaded_plugins})
+
+
+    @routes.route('GET','/cache')
+    @routes.route('POST','/cache')
+    async def cache_stats(request):
+        ctx = RequestContext(request)
+        await ctx.json()
+        if not check_auth(ctx, config):
+            return jsoncodec.json_response({'error': 'unauthorized'}, status=403)
+        return jsoncodec.json_response({'response_cache': response_cache.stats() if response_cache else {}})
+
+    @routes.route('GET','/metrics')
+    @routes.route('POST','/metrics')
+    async def metrics_report(request):
+        ctx = RequestContext(request)
+        await ctx.json()
+        if not check_auth(ctx, config):
+            return jsoncodec.json_response({'error': 'unauthorized'}, status=403)
+        if not request_metrics:
+            return jsoncodec.json_response({'error': 'metrics are disabled'}, status=404)
+        extra = {}
+        if response_cache:
+            for k, v in response_cache.stats().items():
+                mtype = 'counter' if k in ('hits', 'misses', 'coalesced', 'evictions', 'uncacheable') else 'gauge'
+                name = f"pserv_response_cache_{k}{'_total' if mtype == 'counter' else ''}"
+                extra[name] = (mtype, f"Response cache {k.replace('_', ' ')}.", v)
+        return web.Response(text=request_metrics.render(extra), content_type='text/plain',
+                            headers={'X-Content-Type-Options': 'nosniff'})
 
+    @routes.route('GET', '/reload/all')
+    @routes.route('POST', '/reload/all')
+    async def reload_all(request):
+        current_config_for_auth = globalCfg
+
+        ctx = RequestContext(request)
+        await ctx.json()
+        if not check_auth(ctx, current_config_for_auth):
+            return jsoncodec.json_response({'error': 'unauthorized'}, status=403)
+        
+        try:
+            reloaded_cfg = configfile.Config(file=config_file)
+            globals()['globalCfg'] = reloaded_cfg
+            configure_json(reloaded_cfg)
+            if manager:
+                manager.reset_config(reloaded_cfg)
+                await manager.load_plugins()
+                plugin_table.rebuild(manager.plugins)
+                response_cache.clear()
+                return jsoncodec.json_response({'status': 'All plugins reloaded', 'loaded_plugins': list(manager.plugins.keys())})
+            else:
+                return jsoncodec.json_response({'error': 'Plugin manager not available'}, status=500)
+        except Exception as e:
+            log.exception(f"Error reloading all plugins: {e}")
+            return jsoncodec.json_response({'error': 'Failed to reload all plugins'}, status=500)
 
     @routes.route('GET','/reload/{plugin_id}')
     @routes.route('POST','/reload/{plugin_id}')
     async def reload_plugin(request):
         current_config_for_auth = globalCfg
 
-        data = {}
-        if request.method == 'POST' and request.can_read_body:
-            try: data.update(await request.json())
-            except Exception: pass
-        data.update(request.query)
-        data['request_headers'] = dict(request.headers)
-        if not check_auth(data, current_config_for_auth):
-            return web.json_response({'error': 'unauthorized'}, status=403)
+        ctx = RequestContext(request)
+        await ctx.json()
+        if not check_auth(ctx, current_config_for_auth):
+            return jsoncodec.json_response({'error': 'unauthorized'}, status=403)
 
         pid = request.match_info['plugin_id']
         if manager and pid in manager.plugins:
@@ -383,38 +563,13 @@ def register_control_routes(config):
                 globals()['globalCfg'] = reloaded_cfg
                 manager.reset_config(reloaded_cfg)
                 success = await manager.reload_plugin(pid)
-                web.json_response({'reloaded': pid, 'success': success})
+                plugin_table.rebuild(manager.plugins)
+                response_cache.clear()
+                return jsoncodec.json_response({'reloaded': pid, 'success': success})
             except Exception as e:
                 log.exception(f"Error reloading plugin {pid}: {e}")
-                return web.json_response({'error': f'Failed to reload plugin {pid}'}, status=500)
-        web.json_response({'error': f'Plugin "{pid}" not found'}, status=404)
-
-    @routes.route('GET', '/reload/all')
-    @routes.route('POST', '/reload/all')
-    async def reload_all(request):
-        current_config_for_auth = globalCfg
-
-        data = {}
-        if request.method == 'POST' and request.can_read_body:
-            try: data.update(await request.json())
-            except Exception: pass
-        data.update(request.query)
-        data['request_headers'] = dict(request.headers)
-        if not check_auth(data, current_config_for_auth):
-            return web.json_response({'error': 'unauthorized'}, status=403)
-        
-        try:
-            reloaded_cfg = configfile.Config(file=config_file)
-            globals()['globalCfg'] = reloaded_cfg
-            if manager:
-                manager.reset_config(reloaded_cfg)
-                await manager.load_plugins()
-                return web.json_response({'status': 'All plugins reloaded', 'loaded_plugins': list(manager.plugins.keys())})
-            else:
-                return web.json_response({'error': 'Plugin manager not available'}, status=500)
-        except Exception as e:
-            log.exception(f"Error reloading all plugins: {e}")
-            return web.json_response({'error': 'Failed to reload all plugins'}, status=500)
+                return jsoncodec.json_response({'error': f'Failed to reload plugin {pid}'}, status=500)
+        return jsoncodec.json_response({'error': f'Plugin "{pid}" not found'}, status=404)
 
 async def maybe_async(value):
     return await value if inspect.isawaitable(value) else value
@@ -424,12 +579,59 @@ def reload(signum, frame):
     log(f"Received {get_signal_name(signum)} - Terminating plugins")
     _sched_sh(_sh_then_act, _act_execl)
 
+def worker_reload(signum, frame):
+    global log
+    log(f"Received {get_signal_name(signum)} - Terminating plugins for worker exit")
+    _sched_sh(_sh_then_act, _act_worker_exit, 0)
+
 def terminate(signum, frame, sig_to_exit_code=None):
     global log
     actual_exit_code = sig_to_exit_code if sig_to_exit_code is not None else signum
     log(f"Received {get_signal_name(signum)} - Terminating plugins")
     _sched_sh(_sh_then_act, _act_exit, actual_exit_code)
 
+def run_worker(args, sock):
+    try:
+        asyncio.run(pserve_main(args, sock=sock))
+    finally:
+        logjam.shutdown()
+    return _signal_exit_code
+
+def run_supervisor(args):
+    """
+    Run pserv as a supervisor with args.workers pre-forked workers sharing
+    the network.bindto:network.port listening socket.
+    """
+    global log
+    we_are = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if args.log:
+        log = logjam.LogJam(file=args.log, name=f"{we_are}-supervisor", level=args.level.upper())
+    else:
+        log = logjam.LogJam(name=f"{we_are}-supervisor", level=args.level.upper())
+    cfg = configfile.Config(file=args.ini_file)
+    if not 'network' in cfg:
+        log(f"Configuration error: 'network' not found in '{args.ini_file}'.")
+        return 1
+    pidfile = cfg.paths.get('pidfile') if 'paths' in cfg else None
+    if pidfile:
+        with open(pidfile,'w') as f:
+            print(f"{os.getpid()}",file=f)
+    supervisor = prefork.Supervisor(
+        workers=args.workers,
+        bindto=cfg.network.bindto,
+        port=cfg.network.port,
+        reuse_port=configfile.value_bool(cfg.network.get('reuse_port', False)),
+        target=lambda sock: run_worker(args, sock),
+        log=log)
+    try:
+        return supervisor.run()
+    finally:
+        if pidfile:
+            try:
+                os.unlink(pidfile)
+            except OSError:
+                pass
+
 def main():
     global log
     global _signal_exit_code
@@ -443,14 +645,18 @@ def main():
     parser.add_argument('-i','--ini-file',default=f"{we_are}.ini",type=str, metavar='ini-file',help='Use an alternate config file')
     parser.add_argument('-l','--log',default=None,type=str,metavar='file',help='Set a log file')
     parser.add_argument('-v','--level',default='DEBUG',type=str,help="Logging level, INFO DEBUG ERROR CRITICAL", metavar='level')
+    parser.add_argument('-w','--workers',default=1,type=int,metavar='N',help="Number of pre-forked worker processes")
     args = parser.parse_args()
 
     exit_code = 0
     _signal_exit_code = 0
 
     try:
-        asyncio.run(pserve_main(args))
-        exit_code = _signal_exit_code
+        if args.workers > 1:
+            exit_code = run_supervisor(args)
+        else:
+            asyncio.run(pserve_main(args))
+            exit_code = _signal_exit_code
     except KeyboardInterrupt:
         log.info("Application terminated by KeyboardInterrupt (caught in main).")
         exit_code = getattr(signal.SIGINT, 'value', 2)
@@ -462,6 +668,7 @@ def main():
         exit_code = 1
     finally:
         log.info(f"Application exiting with code {exit_code}.")
+        logjam.shutdown()
 
     sys.exit(exit_code)
   
@@ -0,0 +1,134 @@
+"""
+Response cache for plugins.
+
+pserv owns a single ResponseCache and hands it to every plugin. Plugins opt in
+with a cache_ttl, either as a class attribute or through plugin_parms, e.g.
+
+    [plugin_parms]
+    systeminfo=cache_ttl=2
+
+BasePlugin then answers GET requests for the same path and query from the
+cache until the ttl runs out. The cache key doesn't include request headers,
+so only complete 200 responses without cookies, a Vary header or a
+Content-Encoding are stored; anything else would be replayed to clients it
+wasn't made for. Concurrent misses on the same key are coalesced so the
+plugin only computes the response once.
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from aiohttp import web
+
+_skip_headers = ('Content-Length', 'Set-Cookie', 'Transfer-Encoding')
+
+class CachedResponse:
+    __slots__ = ('status', 'body', 'headers', 'expires', 'size')
+
+    def __init__(self, response, ttl):
+        self.status = response.status
+        self.body = response.body
+        self.headers = [(k, v) for k, v in response.headers.items() if k not in _skip_headers]
+        self.expires = time.monotonic() + ttl
+        self.size = len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+    def to_response(self):
+        return web.Response(body=self.body, status=self.status, headers=self.headers)
+
+def cacheable(response):
+    return (isinstance(response, web.Response)
+            and response.status == 200
+            and not response.prepared
+            and not response.cookies
+            and 'Vary' not in response.headers
+            and 'Content-Encoding' not in response.headers
+            and isinstance(response.body, bytes))
+
+class ResponseCache:
+    """
+    LRU cache of plugin responses bounded by entry count and total body bytes.
+    """
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def _store(self, key, ttl, response):
+        if not cacheable(response):
+            self.uncacheable += 1
+            return None
+        entry = CachedResponse(response, ttl)
+        if entry.size > self.max_bytes:
+            self.uncacheable += 1
+            return None
+        self._drop(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, old = self._entries.popitem(last=False)
+            self.bytes -= old.size
+            self.evictions += 1
+        return entry
+
+    async def fetch(self, key, ttl, compute):
+        """
+        return the cached response for key, or await compute() for a new one
+        and cache it for ttl seconds.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.to_response()
+            self._drop(key)
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            entry = await asyncio.shield(pending)
+            if entry is not None:
+                return entry.to_response()
+            return await compute()
+
+        self.misses += 1
+        pending = asyncio.get_running_loop().create_future()
+        self._inflight[key] = pending
+        entry = None
+        try:
+            response = await compute()
+            entry = self._store(key, ttl, response)
+            return response
+        finally:
+            del self._inflight[key]
+            pending.set_result(entry)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'uncacheable': self.uncacheable,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -2,11 +2,407 @@ import time
 import os
 import mimetypes
 import re
+import gzip
+import zlib
+import asyncio
+import threading
+import html
+from urllib.parse import quote
+from email.utils import formatdate
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from plugincore.baseplugin import BasePlugin
+from plugincore import accesslog, jsoncodec, pluginmanager
 from aiohttp import web
 from bs4 import BeautifulSoup
 import markdown
 import aiofiles
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content coding -> suffix of a precompressed sibling file
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+RENDER_EXECUTORS = ('thread', 'process')
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/json', 'application/xml',
+                      'application/xhtml+xml', 'image/svg+xml')
+
+# The render stages below are module level functions of plain strings so they
+# can run in a thread or be pickled over to a process pool.
+
+_converters = threading.local()
+
+def markdown_body(text):
+    """
+    convert markdown text to an html fragment. Setting up the extensions is
+    a good part of the cost of a conversion, so each thread keeps its own
+    Markdown instance and resets it between documents.
+    """
+    md = getattr(_converters, 'markdown', None)
+    if md is None:
+        md = _converters.markdown = markdown.Markdown(extensions=['fenced_code', 'tables','codehilite'])
+    return md.reset().convert(text)
+
+def retitle_html(text, title):
+    """ set (or add) the <title> of an html document """
+    soup = BeautifulSoup(text, "html.parser")
+    # Modify existing title
+    if soup.title:
+        soup.title.string = title
+    else:
+        # Create a <title> tag if it doesn't exist
+        new_title = soup.new_tag("title")
+        new_title.string = title
+        if soup.head:
+            soup.head.append(new_title)
+        else:
+            new_head = soup.new_tag("head")
+            new_head.append(new_title)
+            soup.html.insert(0, new_head)
+    return str(soup)
+
+def file_stamp(path):
+    """ (mtime_ns, size) for path, or None if it can't be stat'ed """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+class Dependencies:
+    """
+    The files a page was rendered from, with their stamps taken as they were
+    read, and whether the page shows the current time (@TIME@).
+    """
+    def __init__(self):
+        self.stamps = {}
+        self.volatile = False
+
+    def add(self, path):
+        if path not in self.stamps:
+            self.stamps[path] = file_stamp(path)
+
+class RenderedPage:
+    """
+    A page body plus the compressed variants made from it, keyed by
+    content coding ('gzip', 'br').
+    """
+    __slots__ = ('content', 'mime', 'stamps', 'expires', 'variants', 'size', '_etag')
+
+    def __init__(self, content, mime, stamps, expires=None):
+        self.content = content
+        self.mime = mime
+        self.stamps = stamps
+        self.expires = expires
+        self.variants = {}
+        self.size = len(content)
+        self._etag = None
+
+    def etag(self, encoding=None):
+        if self._etag is None:
+            self._etag = f"{zlib.crc32(self.content):08x}-{len(self.content):x}"
+        return f'"{self._etag}-{encoding}"' if encoding else f'"{self._etag}"'
+
+class RenderCache:
+    """
+    Rendered markdown and html pages keyed by file name, bounded by the total
+    size of the pages and their compressed variants and evicted least
+    recently used first. A page is only served from the cache while every
+    file it was built from (the page, its includes, @FILETIME@ targets and
+    the markdown envelope) is unchanged.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _drop(self, key):
+        page = self.pages.pop(key, None)
+        if page is not None:
+            self.bytes -= page.size
+
+    def _trim(self):
+        while self.bytes > self.max_bytes:
+            _, page = self.pages.popitem(last=False)
+            self.bytes -= page.size
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is not None:
+            if page.expires and page.expires < time.monotonic():
+                self._drop(key)
+                page = None
+            elif any(file_stamp(path) != stamp for path, stamp in page.stamps.items()):
+                self._drop(key)
+                self.invalidations += 1
+                page = None
+        if page is None:
+            self.misses += 1
+            return None
+        self.pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+    def put(self, key, page):
+        if page.size > self.max_bytes:
+            return
+        self._drop(key)
+        self.pages[key] = page
+        self.bytes += page.size
+        self._trim()
+
+    def add_variant(self, key, page, encoding, body):
+        page.variants[encoding] = body
+        page.size += len(body)
+        if self.pages.get(key) is page:
+            self.bytes += len(body)
+            self._trim()
+
+def accepted_encodings(header):
+    """ the content codings in an Accept-Encoding header that we know, best first """
+    accepted = []
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        if coding not in ENCODINGS:
+            continue
+        q = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            # brotli wins a tie, it compresses text better than gzip
+            accepted.append((q, coding == 'br', coding))
+    return [coding for _, _, coding in sorted(accepted, reverse=True)]
+
+def compressible(mime):
+    return mime.startswith('text/') or mime in COMPRESSIBLE_TYPES
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def etag_matches(header, etag):
+    """ does an If-None-Match header match etag (weak comparison) """
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+# Envelope fields, {name} or {self.name}
+ENVELOPE_FIELD = re.compile(r'{(?:self\.)?(\w+)}')
+
+class Envelope:
+    """
+    The page markdown is wrapped in, split once into literal text and
+    fields. Fields without a value are left as they were written.
+    """
+    __slots__ = ('parts', 'stamp')
+
+    def __init__(self, text, stamp=None):
+        self.stamp = stamp
+        self.parts = []         # literal text, then (name, original) for each field
+        last = 0
+        for match in ENVELOPE_FIELD.finditer(text):
+            self.parts.append(text[last:match.start()])
+            self.parts.append((match.group(1), match.group(0)))
+            last = match.end()
+        self.parts.append(text[last:])
+
+    def render(self, context):
+        return ''.join(part if isinstance(part, str) else str(context.get(part[0], part[1]))
+                       for part in self.parts)
+
+DEFAULT_ENVELOPE = Envelope("""<!DOCTYPE html>
+                <html>
+                <head>
+                    <title>{title}</title>
+                    <link rel="stylesheet" href="{markdown_css}">
+                    <link rel="stylesheet" href="{highlight_css}">
+                </head>
+                <body>
+                {mdhtml}
+                </body>
+                </html>""")
+
+# Page directives, @NAME=value@. A backslash in front (\@NAME=value@) escapes
+# a directive, it is output without the backslash.
+DIRECTIVE = re.compile(r'(\\)?@([A-Za-z]+)=([^@]+)@')
+TEXT, INCLUDE, FILETIME, TIME = range(4)
+DIRECTIVES = {'INCLUDE': INCLUDE, 'FILETIME': FILETIME, 'TIME': TIME}
+
+class Template:
+    """
+    A page parsed once into a list of (kind, value) tokens: TEXT with the
+    literal text, INCLUDE with a file name, FILETIME with (file name,
+    format) and TIME with its format. @TITLE@ is taken out while parsing,
+    the last one wins. Unknown directives are kept as text.
+    """
+    __slots__ = ('tokens', 'title', 'volatile', 'stamp')
+
+    def __init__(self, text, stamp=None):
+        self.tokens = []
+        self.title = ''
+        self.volatile = False
+        self.stamp = stamp
+        pending = []
+        last = 0
+        for match in DIRECTIVE.finditer(text):
+            escaped, name, value = match.groups()
+            pending.append(text[last:match.start()])
+            last = match.end()
+            if escaped:
+                pending.append(match.group(0)[1:])
+                continue
+            if name == 'TITLE':
+                self.title = value
+                continue
+            kind = DIRECTIVES.get(name)
+            if kind is None:
+                pending.append(match.group(0))
+                continue
+            self._text(pending)
+            pending = []
+            if kind == FILETIME:
+                filename, _, format = value.partition('+')
+                value = (filename, format)
+            elif kind == TIME:
+                self.volatile = True
+            self.tokens.append((kind, value))
+        pending.append(text[last:])
+        self._text(pending)
+
+    def _text(self, parts):
+        text = ''.join(parts)
+        if text:
+            self.tokens.append((TEXT, text))
+
+class TemplateCache:
+    """
+    Parsed templates keyed by path, reparsed when the file's mtime or size
+    changes and evicted least recently used first past max_entries.
+    """
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.templates = OrderedDict()
+
+    async def load(self, path, deps=None):
+        stamp = file_stamp(path)
+        if deps is not None:
+            deps.stamps.setdefault(path, stamp)
+        template = self.templates.get(path)
+        if template is not None and stamp is not None and template.stamp == stamp:
+            self.templates.move_to_end(path)
+            return template
+        async with aiofiles.open(path,'rb') as f:
+            text = await f.read()
+        template = Template(text.decode('utf-8'), stamp)
+        if self.max_entries > 0:
+            self.templates[path] = template
+            self.templates.move_to_end(path)
+            while len(self.templates) > self.max_entries:
+                self.templates.popitem(last=False)
+        return template
+
+class IndexEntry:
+    __slots__ = ('path', 'name', 'is_dir', 'size', 'mtime', 'mtime_ns', 'mime')
+
+    def __init__(self, path, is_dir, st):
+        self.path = path                # relative to the document root, '/' separated
+        self.name = path.rsplit('/', 1)[-1]
+        self.is_dir = is_dir
+        self.size = 0 if is_dir else st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.mime = None if is_dir else mimetypes.guess_type(self.name)[0] or 'application/octet-stream'
+
+class DocumentIndex:
+    """
+    An in-memory index of the documents tree: every file and directory by
+    its path relative to the root, with type, size, mtime and mime type.
+    Lookups never touch the file system. scan() walks the tree (symlinked
+    directories are not descended into, symlinked files are indexed only
+    when they resolve to a file inside the root) and the result is swapped in whole,
+    so a rescan can run in a thread while requests are answered from the
+    previous index.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.real_root = os.path.realpath(root)
+        self.entries = {}
+        self.children = {}
+        self.listings = {}
+        self.scanned = 0.0
+
+    def scan(self):
+        """ walk the tree, returns (entries, children) for swap() """
+        entries, children = {}, {}
+        entries[''] = IndexEntry('', True, os.stat(self.root))
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            names = []
+            try:
+                with os.scandir(os.path.join(self.root, rel)) as it:
+                    for item in it:
+                        path = f"{rel}/{item.name}" if rel else item.name
+                        try:
+                            if item.is_dir(follow_symlinks=False):
+                                entries[path] = IndexEntry(path, True, item.stat(follow_symlinks=False))
+                                pending.append(path)
+                            elif item.is_file():
+                                if item.is_symlink() and not self.inside(os.path.realpath(item.path)):
+                                    continue
+                                entries[path] = IndexEntry(path, False, item.stat())
+                            else:
+                                continue
+                        except OSError:
+                            continue
+                        names.append(item.name)
+            except OSError:
+                pass
+            children[rel] = sorted(names, key=lambda n: (not entries[f"{rel}/{n}" if rel else n].is_dir, n.lower()))
+        return entries, children
+
+    def inside(self, real_path):
+        """ True if a resolved path is under the resolved root """
+        return real_path.startswith(self.real_root + os.sep)
+
+    def swap(self, scanned):
+        self.entries, self.children = scanned
+        self.listings = {}
+        self.scanned = time.time()
+
+    def resolve(self, subpath):
+        """
+        the entry for a request subpath, or None. The path is looked up as
+        given in the index, so '..' and absolute paths never match anything
+        outside the root.
+        """
+        parts = [part for part in subpath.split('/') if part and part != '.']
+        if '..' in parts:
+            return None
+        return self.entries.get('/'.join(parts))
+
+    def stamp(self, filename):
+        """ file_stamp() for an absolute path under the root, from the index """
+        if not filename.startswith(self.root + os.sep):
+            return None
+        entry = self.entries.get(filename[len(self.root) + 1:].replace(os.sep, '/'))
+        if entry is None or entry.is_dir:
+            return None
+        return entry.mtime_ns, entry.size
 
 class ServeFiles(BasePlugin):
     """
@@ -26,6 +422,7 @@ class ServeFiles(BasePlugin):
             self.log(f"{self._plugin_id}: Using {self.markdown_envelope} for markdown envelope")
         else:
             self.markdown_envelope = None
+        self._envelope = None
         if 'common_log' in self.config.file_server:
             self.log_file = os.path.expanduser(self.config.file_server.common_log)
             self.log(f"{self._plugin_id}: Serve access log is {self.log_file}")
@@ -51,24 +448,93 @@ class ServeFiles(BasePlugin):
         dpath=os.path.expanduser(dpath)
         self._plugin_id = rpath
         self.docpath = dpath
+        cache_size = int(self.config.file_server.get('render_cache', 16 * 1024 * 1024) or 0)
+        self.render_cache = RenderCache(cache_size) if cache_size > 0 else None
+        self.time_ttl = float(self.config.file_server.get('time_ttl', 0) or 0)
+        self.chunk_size = int(self.config.file_server.get('chunk_size', 256 * 1024) or 256 * 1024)
+        self.compression = self.config.file_server.get('compression', True)
+        self.compress_level = int(self.config.file_server.get('compress_level', 6) or 6)
+        self.compress_min = int(self.config.file_server.get('compress_min', 1024) or 0)
+        self.compress_static_max = int(self.config.file_server.get('compress_static_max', 1024 * 1024) or 0)
+        self.compress_offload = int(self.config.file_server.get('compress_offload', 64 * 1024) or 0)
+        if self.compression:
+            self.log(f"{self._plugin_id}: compression on, brotli is {'available' if brotli else 'not installed'}")
+        self.disconnect_poll = float(self.config.file_server.get('disconnect_poll', 0.1) or 0.1)
+        self.render_executor = self._make_render_executor()
+        self.templates = TemplateCache(int(self.config.file_server.get('template_cache', 512) or 0))
+        self.max_include_depth = int(self.config.file_server.get('max_include_depth', 16) or 16)
+        self.index = None
+        self._rescan_task = None
+        self.rescan_interval = float(self.config.file_server.get('index_rescan', 30) or 0)
+        self.listings = self.config.file_server.get('listings', False) or False
+        if self.config.file_server.get('index', False):
+            self.index = DocumentIndex(self.docpath)
+            self.index.swap(self.index.scan())
+            self.log(f"{self._plugin_id}: indexed {len(self.index.entries)} documents, rescan every {self.rescan_interval}s")
+        elif self.listings:
+            self.log.warning(f"{self._plugin_id}: listings need index=bool:true, directory listings are off")
+            self.listings = False
+        self.log(f"{self._plugin_id}: render cache is {cache_size} bytes, @TIME@ pages cached for {self.time_ttl}s")
 
     def retitle_document(self, text, title):
-        soup = BeautifulSoup(text, "html.parser")
-        # Modify existing title
-        if soup.title:
-            soup.title.string = title
-        else:
-            # Create a <title> tag if it doesn't exist
-            new_title = soup.new_tag("title")
-            new_title.string = title
-            if soup.head:
-                soup.head.append(new_title)
-            else:
-                new_head = soup.new_tag("head")
-                new_head.append(new_title)
-                soup.html.insert(0, new_head)
-        return str(soup)
+        return retitle_html(text, title)
+
+    def _make_render_executor(self):
+        kind = self.config.file_server.get('render_executor', 'thread') or 'thread'
+        workers = int(self.config.file_server.get('render_workers', 2) or 0)
+        if kind not in RENDER_EXECUTORS:
+            self.log.error(f"{self._plugin_id}: unknown render_executor {kind}, using thread")
+            kind = 'thread'
+        if workers <= 0:
+            self.log(f"{self._plugin_id}: rendering on the event loop")
+            return None
+        self.log(f"{self._plugin_id}: rendering in a {kind} pool of {workers}")
+        if kind == 'process':
+            # workers import this module by name to unpickle the render functions
+            plugin_dir = os.path.dirname(os.path.abspath(__file__))
+            return ProcessPoolExecutor(max_workers=workers, initializer=pluginmanager.plugin_namespace,
+                                       initargs=(plugin_dir,))
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fileserve-render')
+
+    async def run_render(self, request, func, *args):
+        """
+        run a render stage in the render executor and return its result. If
+        the client goes away first the job is cancelled (a job that already
+        started runs to completion, its result is discarded) and
+        ConnectionResetError is raised.
+        """
+        if self.render_executor is None:
+            return func(*args)
+        future = asyncio.get_running_loop().run_in_executor(self.render_executor, func, *args)
+        while True:
+            done, _ = await asyncio.wait((future,), timeout=self.disconnect_poll)
+            if done:
+                return future.result()
+            transport = getattr(request, 'transport', None)
+            if transport is None or transport.is_closing():
+                future.cancel()
+                raise ConnectionResetError("client disconnected while rendering")
+
+    async def initialize(self, **kwargs):
+        if self.index and self.rescan_interval > 0 and self._rescan_task is None:
+            self._rescan_task = asyncio.create_task(self._rescan(), name=f"{self._plugin_id}:rescan")
+
+    async def _rescan(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.rescan_interval)
+            try:
+                self.index.swap(await loop.run_in_executor(None, self.index.scan))
+            except Exception as e:
+                self.log.error(f"{self._plugin_id}: rescan of {self.docpath} failed: {type(e).__name__}: {e}")
 
+    def terminate_plugin(self):
+        if self._rescan_task is not None:
+            self._rescan_task.cancel()
+            self._rescan_task = None
+        if self.render_executor is not None:
+            self.render_executor.shutdown(wait=False, cancel_futures=True)
+            self.render_executor = None
 
     def error_html(self,code,message):
         return f"""<html>
@@ -80,173 +546,364 @@ class ServeFiles(BasePlugin):
             </body>
         </html>"""
 
-    async def preprocess(self, text, basepath, **args):
-        title = ""
+    async def preprocess(self, text, basepath, deps=None, **args):
+        """ expand the directives in text, returns (title, text) """
         if isinstance(text,bytes):
-            text = text.decode('utf-8')   
-
-        async def run_async_replacer(text,pattern):
-            output = []
-            last_end = 0
-            for match in re.finditer(pattern, text):
-                output.append(text[last_end:match.start()])
-                replacement = await replacer(match)
-                output.append(replacement)
-                last_end = match.end()
-            output.append(text[last_end:])
-            return ''.join(output)
-
-
-        async def replacer(match):
-            nonlocal title
-            tag = match.group(1)
-            value = match.group(2)
-
-            handler = processors.get(f"@{tag}")
-            if handler:
-                return await handler(value)
-            return match.group(0)
-
-        async def include_file(name):
-            nonlocal basepath
-            nonlocal args
-            text = ""
-            name = os.path.expanduser(name)
-            filename = os.path.join(basepath, name) if not os.path.isabs(name) else name
-            mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            try:
-                async with aiofiles.open(filename) as f:
-                    text = await f.read()
-                    _, text = await self.preprocess(text,basepath,**args)
-                    self.log.debug(f"include file {filename} clf is {self.log_includes}")
-                    if self.log_includes:
-                        self.log.common_log(
-                            ip=args.get('client_ip','system') or 'system',
-                            path=filename,
-                            size=len(text),
-                            method = "include",
-                            protocol = "file",
-                            status='OK',file=self.log_file)
+            text = text.decode('utf-8')
+        template = Template(text)
+        deps = deps if deps is not None else Dependencies()
+        chunks = [chunk async for chunk in self.render_tokens(template, basepath, deps, args)]
+        return template.title, ''.join(chunks)
 
-            except Exception as e:
-                message = f"{type(e)} including file {filename}: {e}"
-                self.log.exception(message)
-                return message
+    async def render_tokens(self, template, basepath, deps, args, stack=()):
+        """
+        yield the text of template in chunks, expanding directives as they
+        are reached. stack holds the files being rendered, outermost first,
+        and is used to stop include cycles and runaway nesting.
+        """
+        for kind, value in template.tokens:
+            if kind == TEXT:
+                yield value
+            elif kind == INCLUDE:
+                async for chunk in self.include_file(value, basepath, deps, args, stack):
+                    yield chunk
+            elif kind == FILETIME:
+                yield self.file_date_time(value, basepath, deps)
+            else:
+                deps.volatile = True
+                # a format not starting with + has its first character dropped, +... means %T
+                format = value[1:] if not value.startswith('+') else '%T'
+                yield time.strftime(format, time.localtime(time.time()))
+
+    async def include_file(self, name, basepath, deps, args, stack):
+        """ yield the rendered text of an @INCLUDE@d file, or an error message in its place """
+        name = os.path.expanduser(name)
+        filename = os.path.join(basepath, name) if not os.path.isabs(name) else name
+        if filename in stack:
+            message = f"include cycle: {' -> '.join(stack + (filename,))}"
+            self.log.error(message)
+            yield message
+            return
+        if len(stack) > self.max_include_depth:
+            message = f"includes nested deeper than {self.max_include_depth} at {filename}"
+            self.log.error(message)
+            yield message
+            return
+        mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        size = 0
+        try:
+            template = await self.templates.load(filename, deps)
+            chunks = self.render_tokens(template, basepath, deps, args, stack + (filename,))
             if 'markdown' in mime:
-                text = self.markdown_to_html(text,basepath)
-            return text
-
-        async def set_title(new_title):
-            self.log(f"New document title {new_title}")
-            nonlocal title
-            title = new_title
-            return ''
-        
-        async def cloctime(format):
-            if not format.startswith('+'):
-                format = format[1:]
+                text = ''.join([chunk async for chunk in chunks])
+                text = await self.render_markdown(args.get('request'),text,basepath,deps)
+                size = len(text)
+                yield text
             else:
-                format = '%T'
-            return time.strftime(format, time.localtime(time.time()))
-        
-        async def file_date_time(info):
-            nonlocal basepath
-            filename,format = info.split('+',1)
-            filename = os.path.join(basepath, filename) if not os.path.isabs(filename) else filename
-            try:
-                st = os.stat(filename)
-            except Exception as e:
-                self.log.error(f"{type(e)}: file_data_time: Coulnd't stat {filename}")
-                return ""
-            if not format:
-                format = '%T %D'
-            return time.strftime(format,time.localtime(st.st_mtime))
-
-        processors = {
-            '@INCLUDE': include_file,
-            '@TITLE': set_title,
-            '@FILETIME': file_date_time,
-            '@TIME': cloctime
-        }
-
-        pattern = r'(?<!\\)@([A-Za-z]+)=([^@]+)@'
-        text = await run_async_replacer(text,pattern)
-        text = re.sub(r'\\(@[A-Za-z]+=[^@]+@)', r'\1', text)
-        return title, text
-    
-    def markdown_to_html(self, text,title=""):
-        def render_template(pattern, template: str) -> str:
-            nonlocal title
-            nonlocal mdhtml
-            context = {
-                "title": title,
-                "markdown_css": self.markdown_css,
-                "highlight_css": self.highlight_css,
-                "mdhtml": mdhtml
-            }
-
-            def replacer(match):
-                key = match.group(1)
-                return str(context.get(key, match.group(0)))  # Leave unchanged if key missing
-            return pattern.sub(replacer, template)
+                async for chunk in chunks:
+                    size += len(chunk)
+                    yield chunk
+        except ConnectionResetError:
+            raise
+        except Exception as e:
+            message = f"{type(e)} including file {filename}: {e}"
+            self.log.exception(message)
+            yield message
+            return
+        self.log.debugf("include file %s clf is %s", filename, self.log_includes)
+        if self.log_includes:
+            self.log.common_log(
+                ip=args.get('client_ip','system') or 'system',
+                path=filename,
+                size=size,
+                method = "include",
+                protocol = "file",
+                status='OK',file=self.log_file)
 
+    def file_date_time(self, info, basepath, deps):
+        filename, format = info
+        filename = os.path.join(basepath, filename) if not os.path.isabs(filename) else filename
+        deps.add(filename)
+        try:
+            st = os.stat(filename)
+        except Exception as e:
+            self.log.error(f"{type(e)}: file_data_time: Coulnd't stat {filename}")
+            return ""
+        if not format:
+            format = '%T %D'
+        return time.strftime(format,time.localtime(st.st_mtime))
+
+    def markdown_to_html(self, text,title="",deps=None):
         if isinstance(text,bytes):
-            text = text.decode('utf-8')   
+            text = text.decode('utf-8')
+        return self.wrap_markdown(markdown_body(text),title,deps)
 
-        mdhtml = markdown.markdown(text, extensions=['fenced_code', 'tables','codehilite'])
+    async def render_markdown(self, request, text, title="", deps=None):
+        """ markdown_to_html with the conversion run in the render executor """
+        if isinstance(text,bytes):
+            text = text.decode('utf-8')
+        mdhtml = await self.run_render(request, markdown_body, text)
+        return self.wrap_markdown(mdhtml,title,deps)
+
+    def wrap_markdown(self, mdhtml, title="", deps=None):
+        """ put converted markdown into the envelope """
+        return self.envelope(deps).render({
+            "title": title,
+            "markdown_css": self.markdown_css,
+            "highlight_css": self.highlight_css,
+            "mdhtml": mdhtml
+        })
+
+    def envelope(self, deps=None):
+        """ the compiled markdown envelope, reloaded when its file changes """
         if not self.markdown_envelope:
-            env = """<!DOCTYPE html>
-                <html>
-                <head>
-                    <title>{title}</title>
-                    <link rel="stylesheet" href="{markdown_css}">
-                    <link rel="stylesheet" href="{highlight_css}">
-                </head>
-                <body>
-                {mdhtml}
-                </body>
-                </html>"""
+            return DEFAULT_ENVELOPE
+        if deps is not None:
+            deps.add(self.markdown_envelope)
+        stamp = file_stamp(self.markdown_envelope)
+        if self._envelope is not None and self._envelope.stamp == stamp:
+            return self._envelope
+        try:
+            with open(self.markdown_envelope) as f:
+                self._envelope = Envelope(f.read(), stamp)
+        except Exception as e:
+            self.log.error(f"{self._plugin_id}: can't read markdown envelope {self.markdown_envelope}: {e}")
+            return DEFAULT_ENVELOPE
+        return self._envelope
+
+    async def render_page(self, filename, mime, client_ip=None, request=None):
+        """
+        render a markdown or html page to a RenderedPage. Pages are served
+        from the render cache while the files they were built from are
+        unchanged. Pages using @TIME@ are only cached when time_ttl is set,
+        and then for time_ttl seconds.
+
+        HTML pages without a @TITLE@ that won't be cached anyway are not
+        buffered: an async iterator of their chunks is returned instead.
+        """
+        page = self.render_cache.get(filename) if self.render_cache else None
+        if page:
+            return page
+        deps = Dependencies()
+        template = await self.templates.load(filename, deps)
+        args = {'client_ip': client_ip, 'request': request}
+        chunks = self.render_tokens(template, os.path.dirname(filename), deps, args, (filename,))
+        cacheable = self.render_cache and (self.time_ttl or not template.volatile)
+        if 'text/html' in mime and not template.title and not cacheable:
+            return chunks
+        content = ''.join([chunk async for chunk in chunks])
+        if 'text/markdown' in mime:
+            mime = 'text/html'
+            content = await self.render_markdown(request,content,template.title,deps)
+        if template.title:
+            self.log(f"New document title {template.title}")
+            content = await self.run_render(request,retitle_html,content,template.title)
+        content = content.encode('utf-8')
+        expires = time.monotonic() + self.time_ttl if deps.volatile and self.time_ttl else None
+        page = RenderedPage(content, mime, deps.stamps, expires)
+        if self.render_cache and (self.time_ttl or not deps.volatile):
+            self.render_cache.put(filename, page)
+        return page
+
+    async def encode_page(self, key, page, encodings):
+        """
+        pick the best coding we can produce for page and return (coding, body).
+        Each coding is compressed once and kept with the page; large pages are
+        compressed in the default executor.
+        """
+        if page.size < self.compress_min:
+            return None, page.content
+        for encoding in encodings:
+            if encoding == 'br' and brotli is None:
+                continue
+            body = page.variants.get(encoding)
+            if body is None:
+                if len(page.content) >= self.compress_offload:
+                    body = await asyncio.get_running_loop().run_in_executor(
+                        None, compress, page.content, encoding, self.compress_level)
+                else:
+                    body = compress(page.content, encoding, self.compress_level)
+                if self.render_cache:
+                    self.render_cache.add_variant(key, page, encoding, body)
+                else:
+                    page.variants[encoding] = body
+            return encoding, body
+        return None, page.content
+
+    async def page_response(self, request, key, page, encodings, mtime=None):
+        """
+        respond with page, compressed if the client accepts it; returns
+        (response, size). mtime, for a page that is a file's content, is
+        sent as Last-Modified and checked against If-Modified-Since.
+        """
+        encoding, body = await self.encode_page(key, page, encodings)
+        headers = {'ETag': page.etag(encoding), 'Vary': 'Accept-Encoding'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        if mtime is not None:
+            headers['Last-Modified'] = formatdate(mtime, usegmt=True)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, headers['ETag'])
         else:
-            try:
-                with open(self.markdown_envelope) as f:
-                    env = f.read()
-            except:
-                pass
+            since = request.if_modified_since if mtime is not None else None
+            not_modified = since is not None and int(mtime) <= since.timestamp()
+        if not_modified:
+            return web.Response(status=304, headers=headers), 0
+        return web.Response(body=body, content_type=page.mime, headers=headers), len(body)
 
-        pattern = re.compile(r'{(?:self\.)?(\w+)}')
-        return render_template(pattern, env)
+    def sibling_stamp(self, path):
+        """ stamp of a readable precompressed sibling, from the index when there is one """
+        if self.index:
+            return self.index.stamp(path)
+        return file_stamp(path) if os.access(path, os.R_OK) else None
+
+    async def static_response(self, request, filename, mime, size, mtime_ns, encodings):
+        """
+        respond with a static file; returns (response, size). Compressible
+        files are sent from a fresh .br/.gz sibling when the client accepts
+        it, otherwise small ones are compressed once and kept in the render
+        cache. Everything else goes out through FileResponse, and so do
+        Range requests, which are answered from the uncompressed file.
+        """
+        headers = {'Content-Type': mime}
+        if not compressible(mime):
+            return web.FileResponse(filename, chunk_size=self.chunk_size, headers=headers), size
+        headers['Vary'] = 'Accept-Encoding'
+        for encoding in encodings:
+            path = filename + ENCODINGS[encoding]
+            stamp = self.sibling_stamp(path)
+            if stamp and stamp[0] >= mtime_ns:
+                headers['Content-Encoding'] = encoding
+                return web.FileResponse(path, chunk_size=self.chunk_size, headers=headers), stamp[1]
+        if (encodings and 'Range' not in request.headers and self.compress_min <= size <= self.compress_static_max
+                and any(encoding != 'br' or brotli for encoding in encodings)):
+            page = self.render_cache.get(filename) if self.render_cache else None
+            if page is None:
+                deps = Dependencies()
+                deps.add(filename)
+                async with aiofiles.open(filename,'rb') as f:
+                    content = await f.read()
+                page = RenderedPage(content, mime, deps.stamps)
+                if self.render_cache:
+                    self.render_cache.put(filename, page)
+            return await self.page_response(request, filename, page, encodings, mtime=mtime_ns / 1e9)
+        return web.FileResponse(filename, chunk_size=self.chunk_size, headers=headers), size
+
+    def document_path(self, subpath):
+        """ join subpath to the document root, None if the result would be outside it """
+        root = os.path.abspath(self.docpath)
+        path = os.path.normpath(os.path.join(root, subpath.lstrip('/')))
+        if path != root and not path.startswith(root + os.sep):
+            return None
+        return path
+
+    def listing_response(self, request, entry):
+        """ a directory listing from the index, JSON if asked for with ?format=json or Accept """
+        as_json = (request.query.get('format') == 'json'
+                   or 'application/json' in request.headers.get('Accept', ''))
+        key = (entry.path, as_json)
+        listing = self.index.listings.get(key)
+        if listing is None:
+            names = [n for n in self.index.children.get(entry.path, ()) if not n.startswith('.')]
+            items = [self.index.entries[f"{entry.path}/{n}" if entry.path else n] for n in names]
+            if as_json:
+                body = jsoncodec.dumpb({
+                    'path': '/' + entry.path,
+                    'entries': [{'name': item.name,
+                                 'type': 'directory' if item.is_dir else 'file',
+                                 'size': item.size,
+                                 'mtime': item.mtime,
+                                 'mime': item.mime} for item in items]})
+                listing = (body, 'application/json')
+            else:
+                listing = (self.listing_html(entry, items).encode('utf-8'), 'text/html')
+            self.index.listings[key] = listing
+        body, content_type = listing
+        return web.Response(body=body, content_type=content_type)
+
+    def listing_html(self, entry, items):
+        base = f"/{self._plugin_id}/{entry.path}".rstrip('/')
+        title = html.escape(f"Index of {base}/")
+        rows = []
+        if entry.path:
+            rows.append(f'<tr><td><a href="{quote(base.rsplit("/", 1)[0] + "/")}">../</a></td><td></td><td></td></tr>')
+        for item in items:
+            name = item.name + ('/' if item.is_dir else '')
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(item.mtime))
+            size = '-' if item.is_dir else item.size
+            rows.append(f'<tr><td><a href="{quote(f"{base}/{name}")}">{html.escape(name)}</a></td>'
+                        f'<td>{size}</td><td>{modified}</td></tr>')
+        rows = '\n'.join(rows)
+        return f"""<!DOCTYPE html>
+<html>
+<head><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+<table>
+<tr><th>Name</th><th>Size</th><th>Modified</th></tr>
+{rows}
+</table>
+</body>
+</html>"""
 
     async def request_handler(self, **args):
         code, message, title = 200, '', ''
         request = args.get('request',{'type': 'unknown'})
 
-        filename = args.get('subpath',self.index_file) or self.index_file
-        if not filename:
-            self.log.error(f"{args['client_ip']} - {request.type} - No file name supplied")
-            return 400,web.Response(status=400, text=self.error_html(400,'Bad Request'), content_type='text/html')
-        filename = os.path.join(self.docpath,filename)
-        if not os.path.exists(filename):
-            self.log.error(f"{args['client_ip']} - {request.type} - {filename} not found")
-            return 404,web.Response(status=404, text=self.error_html(404,"Resource Not Found"), content_type='text/html')
-        if os.path.isdir(filename): # If we get a directory, append the indexfile name
-            filename = os.path.join(filename,self.index_file)
+        entry = None
+        if self.index:
+            subpath = args.get('subpath') or ''
+            entry = self.index.resolve(subpath)
+            if entry is not None and entry.is_dir:
+                directory = entry
+                entry = self.index.resolve(f"{directory.path}/{self.index_file}")
+                if entry is None and self.listings:
+                    return 200, self.listing_response(request, directory)
+            if entry is None or entry.is_dir:
+                self.log.error(f"{args['client_ip']} - {request.method} - {subpath} not found")
+                return 404,web.Response(status=404, text=self.error_html(404,"Resource Not Found"), content_type='text/html')
+            filename = os.path.join(self.index.root, entry.path)
+            mime = entry.mime
+        else:
+            filename = args.get('subpath',self.index_file) or self.index_file
+            if not filename:
+                self.log.error(f"{args['client_ip']} - {request.type} - No file name supplied")
+                return 400,web.Response(status=400, text=self.error_html(400,'Bad Request'), content_type='text/html')
+            filename = self.document_path(filename)
+            if filename is None or not os.path.exists(filename):
+                self.log.error(f"{args['client_ip']} - {request.method} - {args.get('subpath')} not found")
+                return 404,web.Response(status=404, text=self.error_html(404,"Resource Not Found"), content_type='text/html')
+            if os.path.isdir(filename): # If we get a directory, append the indexfile name
+                filename = os.path.join(filename,self.index_file)
+            mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
-        mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encodings = accepted_encodings(request.headers.get('Accept-Encoding', '')) if self.compression else []
+        response, size, chunks = None, 0, None
         try:
-            base_path = os.path.dirname(filename)
-            async with aiofiles.open(filename,'rb') as f:
-                content = await f.read()
-            if 'text/markdown' in mime:
-                mime = 'text/html'
-                title, content = await self.preprocess(content,base_path,**args)
-                content = self.markdown_to_html(content,title)
-            elif 'text/html' in mime:
-                title, content = await self.preprocess(content,base_path,**args)
-            if title:
-                content = self.retitle_document(content,title)
-            if not isinstance(content,bytes):
-                content = content.encode('utf-8')
+            if 'text/markdown' in mime or 'text/html' in mime:
+                page = await self.render_page(filename, mime, args.get('client_ip'), request)
+                if isinstance(page, RenderedPage):
+                    response, size = await self.page_response(request, filename, page, encodings)
+                else:
+                    chunks = page
+            else:
+                # static files are sent by web.FileResponse straight from the
+                # file (sendfile where available), it also answers Range and
+                # conditional requests. Check here so errors get our pages.
+                if entry is not None:
+                    size, mtime_ns = entry.size, entry.mtime_ns
+                else:
+                    st = os.stat(filename)
+                    if not os.access(filename, os.R_OK):
+                        raise PermissionError(f"{filename} is not readable")
+                    size, mtime_ns = st.st_size, st.st_mtime_ns
+                response, size = await self.static_response(request, filename, mime, size, mtime_ns, encodings)
+                response[accesslog.PAYLOAD_BYTES] = size
 
+        except ConnectionResetError as e:
+            self.log.debugf("%s - %s - %s: %s", args['client_ip'], request.method, filename, e)
+            code, message = 499, 'Client Closed Request'
         except FileNotFoundError as e:
             self.log.error(f"{args['client_ip']} - {request.method} - {filename} not found: {e}")
             code, message = 404, 'Resource Not Found'
@@ -262,14 +919,19 @@ class ServeFiles(BasePlugin):
         finally:
             if code != 200:
                 response = web.Response(status=code, text=self.error_html(code, message), content_type='text/html')
-            else:
-                #self.log(f"{args['client_ip']} - {filename} {os.path.getsize(filename)} OK")
-                self.log.common_log(
-                    ip=args['client_ip'],
-                    path=filename,
-                    size=len(content),
-                    method = args['request'].method,
-                    protocol = 'HTTPS' if 'SSL' in self.config else 'HTTP',
-                    status='OK',file=self.log_file)
-                response = web.Response(body=content, content_type=mime)
-        return code, response
\ No newline at end of file
+            elif chunks is None:
+                self.log_access(args, filename, size)
+        if code == 200 and chunks is not None:
+            response = await self._stream_response(request, code, chunks, content_type='text/html')
+            self.log_access(args, filename, response.body_length)
+        return code, response
+
+    def log_access(self, args, filename, size):
+        #self.log(f"{args['client_ip']} - {filename} {os.path.getsize(filename)} OK")
+        self.log.common_log(
+            ip=args['client_ip'],
+            path=filename,
+            size=size,
+            method = args['request'].method,
+            protocol = 'HTTPS' if 'SSL' in self.config else 'HTTP',
+            status='OK',file=self.log_file)
\ No newline at end of file
@@ -4,16 +4,36 @@ Session Manager that uses either mongodb or sqlite3 for the backend.
 import os
 import sqlite3
 import uuid
-import json
 import time
 import base64
+import zlib
 import asyncio
-from pymongo import MongoClient
+import queue
+import threading
+import inspect
+import concurrent.futures
+from collections import OrderedDict
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 from plugincore.baseplugin import BasePlugin
+from plugincore import configfile
+from plugincore import jsoncodec
 from aiohttp import web
 from datetime import datetime, timedelta # Add timedelta
 import pytz
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    from compression import zstd    # python 3.14
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
 electrolux_run_flag = True
 
@@ -26,84 +46,518 @@ def sqlite3_create_sql(table):
             timestamp INTEGER NOT NULL,
             session_id TEXT NOT NULL UNIQUE,
             client_ip TEXT NOT NULL,
-            data TEXT NOT NULL
+            data BLOB NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
         );
     """
     return create_sql
 
-def is_connection_closed(conn):
-    try:
-        conn.execute("SELECT 1")
-        return False
-    except sqlite3.ProgrammingError:
-        return True
-    except sqlite3.Error as e:
-         print(f"An unexpected SQLite error occurred: {e}")
-         return True
+def sqlite3_migrate(con, table):
+    """ bring a table made by an older sessman up to date, columns and indexes """
+    columns = [row[1] for row in con.execute(f"PRAGMA table_info({table})")]
+    if 'version' not in columns:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {table}_timestamp ON {table} (timestamp)")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {table}_session ON {table} (session_id, client_ip)")
+
+# Stored session payload: a version byte, a flags byte (serializer in the low
+# nibble, compression in the high one), then the data. Rows written before the
+# payload format hold base64 encoded JSON text; they are still read as is.
+PAYLOAD_VERSION = 1
+SERIALIZERS = {'json': 0, 'msgpack': 1}
+COMPRESSORS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+class SessionPayload:
+    """
+    Encodes session data for the sqlite data column. Payloads of at least
+    compress_min bytes are compressed, unless that doesn't make them
+    smaller. decode() reads every format and the legacy base64 text, no
+    matter how the encoder is configured, so the format can be changed
+    without migrating first.
+    """
+    def __init__(self, *, serializer='json', compression='zlib', compress_min=1024, compress_level=None):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"payload serializer must be one of {', '.join(SERIALIZERS)}, not {serializer}")
+        if compression not in COMPRESSORS:
+            raise ValueError(f"payload compression must be one of {', '.join(COMPRESSORS)}, not {compression}")
+        if serializer == 'msgpack' and msgpack is None:
+            raise ValueError("payload serializer msgpack needs the msgpack package")
+        if compression == 'zstd' and zstd is None:
+            raise ValueError("payload compression zstd needs python 3.14 or the zstandard package")
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_min = compress_min
+        self.compress_level = compress_level
+        code = SERIALIZERS[serializer]
+        self.plain = bytes((PAYLOAD_VERSION, code))
+        self.packed = bytes((PAYLOAD_VERSION, code | COMPRESSORS[compression] << 4))
+
+    def _dump(self, data):
+        if self.serializer == 'msgpack':
+            return msgpack.packb(data, use_bin_type=True)
+        return jsoncodec.dumpb(data)
+
+    def _compress(self, raw):
+        if self.compression == 'zstd':
+            return zstd.compress(raw, self.compress_level or 3)
+        return zlib.compress(raw, self.compress_level or 6)
+
+    def encode(self, data):
+        raw = self._dump(data)
+        if self.compression != 'none' and len(raw) >= self.compress_min:
+            packed = self._compress(raw)
+            if len(packed) < len(raw):
+                return self.packed + packed
+        return self.plain + raw
+
+    @staticmethod
+    def decode(value):
+        if isinstance(value, str):
+            # written before the payload format: base64 encoded JSON
+            return jsoncodec.loads(base64.b64decode(value))
+        if not value or value[0] != PAYLOAD_VERSION:
+            raise ValueError(f"unknown session payload version {value[0] if value else None}")
+        flags = value[1]
+        body = value[2:]
+        compression = flags >> 4
+        if compression == COMPRESSORS['zlib']:
+            body = zlib.decompress(body)
+        elif compression == COMPRESSORS['zstd']:
+            if zstd is None:
+                raise ValueError("session payload is zstd compressed, zstd is not available")
+            body = zstd.decompress(body)
+        elif compression:
+            raise ValueError(f"unknown session payload compression {compression}")
+        serializer = flags & 0x0f
+        if serializer == SERIALIZERS['msgpack']:
+            if msgpack is None:
+                raise ValueError("session payload is msgpack, msgpack is not installed")
+            return msgpack.unpackb(body, raw=False, strict_map_key=False)
+        if serializer:
+            raise ValueError(f"unknown session payload serializer {serializer}")
+        return jsoncodec.loads(body)
+
+def sqlite3_migrate_payloads(con, table, payload, *, rewrite=False, batch=1000):
+    """
+    re-encode stored sessions with payload, the legacy base64 rows or, with
+    rewrite, all of them. Runs in transactions of batch rows; returns
+    (rows, bytes before, bytes after).
+    """
+    select = f"SELECT rowid, data FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+    if not rewrite:
+        select = select.replace("WHERE", "WHERE typeof(data)='text' AND")
+    update = f"UPDATE {table} SET data=? WHERE rowid=?"
+    last, rows, before, after = 0, 0, 0, 0
+    while True:
+        found = con.execute(select, (last, batch)).fetchall()
+        if not found:
+            break
+        changes = []
+        for rowid, value in found:
+            encoded = payload.encode(SessionPayload.decode(value))
+            before += len(value)
+            after += len(encoded)
+            changes.append((encoded, rowid))
+        with con:
+            con.executemany(update, changes)
+        rows += len(changes)
+        last = found[-1][0]
+    return rows, before, after
+
+SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class SqliteWorker(threading.Thread):
+    """
+    A thread that owns one sqlite3 connection. Jobs are functions taking the
+    connection as their first argument; they run one at a time, in the
+    order they were submitted, and their results are handed back to the
+    event loop that submitted them.
+    """
+    def __init__(self, database, name, *, readonly=False, synchronous='NORMAL', busy_timeout=5000, setup=None):
+        super().__init__(name=name, daemon=True)
+        self.database = database
+        self.readonly = readonly
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.setup = setup
+        self.jobs = queue.SimpleQueue()
+        self.pending = 0
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            con = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000, cached_statements=256)
+            if self.setup:
+                self.setup(con)
+            con.execute(f"PRAGMA synchronous={self.synchronous}")
+            if self.readonly:
+                con.execute("PRAGMA query_only=ON")
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                loop, future, fn, args = job
+                result, error = None, None
+                try:
+                    result = fn(con, *args)
+                except Exception as e:
+                    error = e
+                self.pending -= 1
+                if loop is None:
+                    # a blocking call(), future is a concurrent.futures.Future
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+                    continue
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, result, error)
+                except RuntimeError:
+                    pass    # the loop is closed, nobody is waiting any more
+        finally:
+            con.close()
+
+    def submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending += 1
+        self.jobs.put((loop, future, fn, args))
+        return future
+
+    def call(self, fn, *args, timeout=None):
+        """ run fn on this thread and wait for it, for use outside the event loop """
+        future = concurrent.futures.Future()
+        self.pending += 1
+        self.jobs.put((None, future, fn, args))
+        return future.result(timeout)
+
+    def stop(self):
+        self.jobs.put(None)
+
+def _setup_writer(con):
+    # auto_vacuum only takes on a new database, before its first table
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("PRAGMA journal_mode=WAL")
+
+def _transaction(con, fn, *args):
+    with con:
+        return fn(con, *args)
+
+def _fetchone(con, sql, params):
+    return con.execute(sql, params).fetchone()
+
+def _execute(con, sql, params):
+    return con.execute(sql, params).rowcount
+
+def _executemany(con, sql, rows):
+    return con.executemany(sql, rows).rowcount
+
+BATCH_OPS = ('get', 'update', 'create', 'delete')
+
+def batch_runs(operations, kind):
+    """
+    split batch operations, (index, op, ...) tuples, into runs of
+    consecutive operations of the same kind(op), keeping their order
+    """
+    runs = []
+    for operation in operations:
+        k = kind(operation[1])
+        if runs and runs[-1][0] == k:
+            runs[-1][1].append(operation)
+        else:
+            runs.append((k, [operation]))
+    return runs
+
+def _session_batch(con, sql, client_ip, runs):
+    """
+    run batch operations on one database, each run of gets, updates or
+    deletes with one IN (...) lookup and creates and updates with one
+    executemany. Returns {index: (status, (data, version) for a get)}.
+    """
+    results = {}
+    now = int(time.time())
+    for op, ops in runs:
+        if op == 'create':
+            con.executemany(sql['insert'], [(now, session_id, client_ip, value) for _, _, session_id, value in ops])
+            for index, *_ in ops:
+                results[index] = (200, None)
+            continue
+        ids = list({session_id for _, _, session_id, _ in ops})
+        marks = ','.join('?' * len(ids))
+        found = {row[0]: row[1:] for row in con.execute(sql['batch_select'].format(marks=marks), (client_ip, *ids))}
+        if op == 'get':
+            for index, _, session_id, _ in ops:
+                results[index] = (200, found[session_id]) if session_id in found else (404, None)
+        elif op == 'update':
+            con.executemany(sql['update'], [(value, now, session_id, client_ip)
+                                            for _, _, session_id, value in ops if session_id in found])
+            for index, _, session_id, _ in ops:
+                results[index] = (200 if session_id in found else 404, None)
+        elif op == 'delete':
+            con.execute(sql['batch_delete'].format(marks=marks), (client_ip, *ids))
+            for index, _, session_id, _ in ops:
+                # a second delete of the same session in the batch finds nothing
+                results[index] = (200, None) if found.pop(session_id, None) is not None else (404, None)
+    return results
+
+def _touch_then(con, sql, touches, fn, args):
+    if touches:
+        con.executemany(sql, touches)
+    return fn(con, *args)
+
+def _incremental_vacuum(con, pages):
+    """ give up to pages free pages back to the file system, returns how many were """
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free = con.execute("PRAGMA freelist_count").fetchone()[0]
+    con.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return free - con.execute("PRAGMA freelist_count").fetchone()[0]
+
+class SqlitePool:
+    """
+    Connections to one sqlite3 database in WAL mode: a writer thread and a
+    few reader threads. Reads go to the least busy reader and run in
+    parallel with each other and with the writer; writes are serialized on
+    the writer, each job in a transaction of its own. sqlite3 keeps the
+    compiled statements of each connection, so the fixed SQL strings the
+    backends use are only prepared once per connection.
+    """
+    def __init__(self, database, *, readers=2, synchronous='NORMAL', busy_timeout=5000, name='sqlite'):
+        synchronous = str(synchronous).upper()
+        if synchronous not in SYNCHRONOUS:
+            raise ValueError(f"synchronous must be one of {', '.join(SYNCHRONOUS)}, not {synchronous}")
+        self.database = database
+        self.writer = SqliteWorker(database, f"{name}-writer", synchronous=synchronous,
+                                   busy_timeout=busy_timeout, setup=_setup_writer)
+        self.readers = [SqliteWorker(database, f"{name}-reader-{n}", readonly=True, synchronous=synchronous,
+                                     busy_timeout=busy_timeout) for n in range(max(1, readers))]
+        self.workers = [self.writer] + self.readers
+        for worker in self.workers:
+            worker.start()
+            worker.ready.wait()
+            if worker.error:
+                self.close()
+                raise worker.error
+
+    async def read(self, fn, *args):
+        worker = min(self.readers, key=lambda w: w.pending)
+        return await worker.submit(fn, *args)
+
+    async def write(self, fn, *args):
+        return await self.writer.submit(_transaction, fn, *args)
+
+    def write_wait(self, fn, *args, timeout=None):
+        """ write() for callers outside the event loop, blocks until done """
+        return self.writer.call(_transaction, fn, *args, timeout=timeout)
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.stop()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join(timeout=5)
+
+class TouchBuffer:
+    """
+    Write-behind buffer for session touches, the timestamp refresh a get
+    does to slide the ttl. Touches of the same session coalesce, the last
+    one wins, and are written in one executemany transaction every
+    interval seconds or as soon as max_pending sessions are waiting.
+    """
+    def __init__(self, pool, table, *, interval=0.25, max_pending=1024, log=None):
+        self.pool = pool
+        self.sql = f"UPDATE {table} SET timestamp=MAX(timestamp, ?) WHERE session_id=? AND client_ip=?"
+        self.interval = interval
+        self.max_pending = max_pending
+        self.log = log
+        self.pending = {}
+        self.touches = 0
+        self.written = 0
+        self.batches = 0
+        self._task = None
+        self._kicked = None
+
+    def start(self):
+        """ start the periodic flush, must be called with the event loop running """
+        if self._task is None:
+            self._kicked = asyncio.Event()
+            self._task = asyncio.create_task(self._flusher(), name="sessman:touches")
+
+    def touch(self, session_id, client_ip, timestamp):
+        self.pending[(session_id, client_ip)] = timestamp
+        self.touches += 1
+        if len(self.pending) >= self.max_pending and self._kicked:
+            self._kicked.set()
+
+    def _take(self):
+        batch = [(timestamp, session_id, client_ip) for (session_id, client_ip), timestamp in self.pending.items()]
+        self.pending = {}
+        return batch
+
+    def _restore(self, batch):
+        for timestamp, session_id, client_ip in batch:
+            key = (session_id, client_ip)
+            self.pending[key] = max(timestamp, self.pending.get(key, 0))
+
+    async def flush(self):
+        """ write the pending touches, returns how many sessions were written """
+        if not self.pending:
+            return 0
+        batch = self._take()
+        try:
+            await self.pool.write(_executemany, self.sql, batch)
+        except Exception:
+            self._restore(batch)
+            raise
+        self.written += len(batch)
+        self.batches += 1
+        return len(batch)
+
+    async def flush_with(self, fn, *args):
+        """
+        write the pending touches and then run fn(con, *args) in the same
+        writer transaction, so fn sees every touch made before it was
+        called. Returns fn's result.
+        """
+        batch = self._take()
+        try:
+            result = await self.pool.write(_touch_then, self.sql, batch, fn, args)
+        except Exception:
+            self._restore(batch)
+            raise
+        if batch:
+            self.written += len(batch)
+            self.batches += 1
+        return result
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._kicked.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._kicked.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                if self.log:
+                    self.log.error(f"sessman: writing {len(self.pending)} session touches failed: {type(e).__name__}: {e}")
+
+    def close(self):
+        """ stop the periodic flush and write what's pending before returning """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.pending:
+            batch = self._take()
+            self.pool.write_wait(_executemany, self.sql, batch, timeout=30)
+            self.written += len(batch)
+            self.batches += 1
+
+class SweepStats:
+    """ counters of the electrolux sweeps, for /sessman/stats """
+    __slots__ = ('sweeps', 'expired', 'last_expired', 'last_duration', 'max_duration', 'pages_freed')
+
+    def __init__(self):
+        self.sweeps = 0
+        self.expired = 0
+        self.last_expired = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.pages_freed = 0
+
+    def record(self, expired, duration, pages_freed):
+        self.sweeps += 1
+        self.expired += expired
+        self.last_expired = expired
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.pages_freed += pages_freed
+
+    def stats(self):
+        return {
+            'sweeps': self.sweeps,
+            'expired': self.expired,
+            'last_expired': self.last_expired,
+            'last_duration_ms': round(self.last_duration * 1000, 3),
+            'max_duration_ms': round(self.max_duration * 1000, 3),
+            'pages_freed': self.pages_freed,
+        }
 
 async def electrolux(**kwargs):
     """
-    This is the sqlite session database vacuum thread
+    This is the sqlite session database vacuum task. The sweep runs on the
+    pool's writer, so it never blocks the event loop or session reads.
+    Expired rows are found through the timestamp index and deleted batch
+    rows at a time, each batch its own transaction, so other writes get in
+    between batches. Buffered touches are written in the same transaction
+    just before each batch, so a session used since its last written touch
+    is never taken for expired.
+    After the sweep up to vacuum_pages free pages are given back with an
+    incremental vacuum.
     """
     global electrolux_run_flag
     log = kwargs.get('log')
-    required_args = ['database', 'table', 'sem', 'interval', 'ttl']
+    required_args = ['pool', 'table', 'interval', 'ttl']
     for k in required_args:
         if not kwargs.get(k):
             raise AttributeError(f"Required argument missing or invalid: {k}")
-    database = kwargs.get('database')
+    pool = kwargs.get('pool')
     table = kwargs.get('table')
-    sem = kwargs.get('sem')
+    touches = kwargs.get('touches')
     interval = kwargs.get('interval')
     ttl = kwargs.get('ttl')
-    con = None
+    batch = kwargs.get('batch') or 500
+    vacuum_pages = kwargs.get('vacuum_pages', 1024)
+    stats = kwargs.get('stats') or SweepStats()
     error_attempts = 0
     max_errors = 50
+    expire_sql = (f"DELETE FROM {table} WHERE rowid IN "
+                  f"(SELECT rowid FROM {table} WHERE timestamp < ? LIMIT ?)")
     loop_start_time = time.time() - interval
-    try:
-        while electrolux_run_flag:
-            current_time = time.time()
-            if (time.time() - loop_start_time) > interval:
-                loop_start_time = time.time()
-                if not con or is_connection_closed(con):
-                    try:
-                        if os.path.exists(database):
-                            con = sqlite3.connect(database)
-                    except Exception as e:
-                        log.exception(f"electrolux: Could not establish a connection on database {database}: {e}")
-                        error_attempts = error_attempts + 1
-                        if (error_attempts > max_errors):
-                            raise
-                try:
-                    async with sem:
-                        aged = int(time.time()) - ttl
-                        cur = con.cursor()
-                        cur.execute(f"""
-                            DELETE FROM {table} WHERE timestamp < ?;
-                        """, (aged,))
-                        con.commit()  # Ensure changes are written
-                        cur.close()
-                        error_attempts = 0
-                except sqlite3.Error as e:
-                    log.exception(f"SQLite error in electrolux thread: {e}")
-                    if con:
-                        con.rollback()  # Rollback any pending changes
-                        con.close()
-                        error_attempts = error_attempts + 1
-                        if (error_attempts > max_errors):
-                            raise
-                except Exception as e:
-                    log.exception(f"An unexpected error occurred in electrolux thread: {e}")
-                    error_attempts = error_attempts + 1
-                    if (error_attempts > max_errors):
-                        raise
-            await asyncio.sleep(1)
-    finally:
-        if con:
-            con.close()
-
-db_semaphore = asyncio.Lock()
-db_vacuum = None
+    while electrolux_run_flag:
+        if (time.time() - loop_start_time) > interval:
+            loop_start_time = time.time()
+            try:
+                start = time.perf_counter()
+                aged = int(time.time()) - ttl
+                expired = 0
+                while True:
+                    if touches:
+                        deleted = await touches.flush_with(_execute, expire_sql, (aged, batch))
+                    else:
+                        deleted = await pool.write(_execute, expire_sql, (aged, batch))
+                    expired += deleted
+                    if deleted < batch:
+                        break
+                    await asyncio.sleep(0)
+                freed = await pool.write(_incremental_vacuum, vacuum_pages) if expired and vacuum_pages else 0
+                duration = time.perf_counter() - start
+                stats.record(expired, duration, freed)
+                log.debugf("electrolux: expired %d sessions in %.1fms, freed %d pages", expired, duration * 1000, freed)
+                error_attempts = 0
+            except Exception as e:
+                log.exception(f"An unexpected error occurred in electrolux: {e}")
+                error_attempts = error_attempts + 1
+                if (error_attempts > max_errors):
+                    raise
+        await asyncio.sleep(1)
 
 class SessionDatabase:
     """ Base class for session database handlers """
@@ -114,102 +568,378 @@ class SessionDatabase:
         self.password = kwargs.get('password')                  # password for db (mongodb)
         self.server_url = kwargs.get('server_url')              # server url for mongodb
         self.session_ttl = kwargs.get('session_ttl',86400)      # session ttl
-        self.sem = db_semaphore
         self.data = kwargs.get('data',{})
         self.kwargs = kwargs
 
     def _encode_data(self,data):
-        jdata = json.dumps(data).encode('utf-8')
-        bdata = base64.b64encode(jdata).decode('utf-8')
-        return bdata
+        return self.payload.encode(data)
 
     def _decode_data(self,bdata):
-        bdata = bdata.encode('utf-8')
-        jdata = base64.b64decode(bdata).decode('utf-8')
-        return json.loads(jdata)
+        return SessionPayload.decode(bdata)
+
+    async def get_session_entry(self, session_id, client_ip):
+        """
+        (data, version, expires) for a session, or None. expires is the
+        time.time() the session expires at when that is fixed, None when
+        the ttl slides with every use
+        """
+        raise NotImplementedError
+
+    async def session_version(self, session_id, client_ip):
+        """ the version of a session, bumped by every update, or None if there is no such session """
+        raise NotImplementedError
+
+    def touch_session(self, session_id, client_ip):
+        """ slide the ttl of a session that was read from the cache """
+        pass
+
+    def session_expires(self):
+        """ when a session created now expires, None if its ttl slides with use """
+        return None
+
+    async def run_batch(self, client_ip, operations):
+        """
+        run validated batch operations, (index, op, session_id, data)
+        tuples, in order. Returns {index: result} where a result holds the
+        operation's status, session_id and data or error.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+class SessionCache:
+    """
+    LRU cache of decoded session data keyed by (session_id, client_ip),
+    bounded by entry count and by the encoded size of the data. An entry
+    lives for ttl seconds from when it was last used, like the session's
+    own sliding ttl, and never past expires, the time a session that
+    doesn't slide (MongoDB's) is removed from the database.
+
+    A read that raced an update must not cache what it read: callers take
+    generation() before reading the database and hand it to put(), which
+    skips the entry if the session was invalidated since. The generation
+    of each invalidation is remembered for the most recent max_entries
+    invalidated sessions; past that put() only caches reads that started
+    after the oldest remembered one.
+    """
+    __slots__ = ('ttl', 'max_entries', 'max_bytes', 'entries', 'bytes', 'generations', 'forgotten', '_generation',
+                 'hits', 'misses', 'stale', 'invalidations', 'evictions', 'raced')
+
+    class Entry:
+        __slots__ = ('data', 'version', 'size', 'expires', 'deadline')
+
+        def __init__(self, data, version, size, expires, deadline):
+            self.data = data
+            self.version = version
+            self.size = size
+            self.expires = expires
+            self.deadline = deadline
+
+    def __init__(self, *, ttl, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generations = OrderedDict()
+        self.forgotten = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.raced = 0
+
+    def generation(self):
+        """ token to take before reading a session from the database, for put() """
+        return self._generation
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+    def get(self, session_id, client_ip):
+        key = (session_id, client_ip)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None and (entry.expires < now or (entry.deadline and entry.deadline <= time.time())):
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        entry.expires = now + self.ttl
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, session_id, client_ip, data, version, since=None, expires=None):
+        """
+        cache data read from the database. since is the generation() taken
+        before the read; if the session was invalidated after it the data
+        may be older than the database and is not cached. expires is the
+        time.time() the session itself expires at, if that is fixed.
+        """
+        key = (session_id, client_ip)
+        if since is not None and self.generations.get(key, self.forgotten) > since:
+            self.raced += 1
+            return
+        size = len(jsoncodec.dumpb(data))
+        self._drop(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = self.Entry(data, version, size, time.monotonic() + self.ttl, expires)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.size
+            self.evictions += 1
+
+    def invalidate(self, session_id, client_ip, stale=False):
+        key = (session_id, client_ip)
+        self._generation += 1
+        self.generations.pop(key, None)
+        self.generations[key] = self._generation
+        if len(self.generations) > max(self.max_entries, 1024):
+            _, self.forgotten = self.generations.popitem(last=False)
+        if self._drop(key) is not None:
+            if stale:
+                self.stale += 1
+            else:
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+            'raced': self.raced,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class SqliteShard:
+    """
+    One database file of the sqlite session store, with everything that
+    works on it: the connection pool, the touch buffer and the expiry
+    sweep. Shards share nothing, so work on different shards runs in
+    parallel, each on its own writer thread.
+    """
+    def __init__(self, database, table, *, name='sqlite', log=None):
+        self.database = database
+        self.table = table
+        self.name = name
+        self.log = log
+        self.pool = None
+        self.touches = None
+        self.vacuum = None
+        self.sweeps = SweepStats()
+
+    async def open(self, *, ttl, **kwargs):
+        """ open the pool, create or migrate the table, start the touches and the sweep """
+        self.pool = SqlitePool(self.database,
+                               readers=int(kwargs.get('readers', 2)),
+                               synchronous=kwargs.get('synchronous', 'NORMAL'),
+                               busy_timeout=int(kwargs.get('busy_timeout', 5000)),
+                               name=self.name)
+        await self.pool.write(_execute, sqlite3_create_sql(self.table), ())
+        await self.pool.write(sqlite3_migrate, self.table)
+        self.touches = TouchBuffer(self.pool, self.table,
+                                   interval=float(kwargs.get('touch_interval_ms', 250)) / 1000,
+                                   max_pending=int(kwargs.get('touch_batch', 1024)),
+                                   log=self.log)
+        self.touches.start()
+        vargs = {
+            'pool': self.pool,
+            'touches': self.touches,
+            'table': self.table,
+            'ttl': ttl,
+            'interval': kwargs.get('vacuum_interval',60),
+            'batch': int(kwargs.get('expire_batch', 500)),
+            'vacuum_pages': int(kwargs.get('vacuum_pages', 1024)),
+            'stats': self.sweeps,
+            'log': self.log,
+        }
+        self.vacuum = asyncio.create_task(electrolux(**vargs), name=f"vacuum_thread:electrolux:{self.name}")
+
+    def close(self):
+        if self.vacuum:
+            self.vacuum.cancel()
+            self.vacuum = None
+        if self.touches:
+            try:
+                self.touches.close()
+            except Exception as e:
+                self.log.error(f"sessman: writing session touches of {self.database} on close failed: {type(e).__name__}: {e}")
+            self.touches = None
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
+    def stats(self):
+        stats = {'database': self.database, 'expiry': self.sweeps.stats()}
+        touches = self.touches
+        if touches:
+            stats['touches'] = {
+                'pending': len(touches.pending),
+                'touches': touches.touches,
+                'written': touches.written,
+                'batches': touches.batches,
+            }
+        return stats
+
+def shard_databases(database, shards):
+    """ the database files of a store with shards shards: sessions.db -> sessions.0.db ... """
+    if shards <= 1:
+        return [database]
+    root, ext = os.path.splitext(database)
+    return [f"{root}.{n}{ext}" for n in range(shards)]
 
 class SessionSqlite(SessionDatabase):
+    """
+    sqlite3 sessions. All database work runs on a SqlitePool, reads on the
+    reader threads and writes on the writer thread, so nothing blocks the
+    event loop and no lock is needed. With shards greater than 1 sessions
+    are spread over that many database files by a hash of the session id,
+    so writes to different shards don't wait for each other.
+    """
     def __init__(self,**kwargs):
         super().__init__(**kwargs)
-        self.db_con = None
         self.log = kwargs.get('log')
         if not getattr(self,'database'):
             raise ValueError('No database specified')
+        count = int(kwargs.get('shards', 1) or 1)
+        if count < 1:
+            raise ValueError(f"shards must be 1 or more, not {count}")
+        self.shards = [SqliteShard(database, self.collection, name=f"sqlite{n}" if count > 1 else 'sqlite', log=self.log)
+                       for n, database in enumerate(shard_databases(self.database, count))]
+        compress_level = kwargs.get('payload_compress_level')
+        self.payload = SessionPayload(serializer=kwargs.get('payload_format', 'json'),
+                                      compression=kwargs.get('payload_compression', 'zlib'),
+                                      compress_min=int(kwargs.get('payload_compress_min', 1024)),
+                                      compress_level=int(compress_level) if compress_level is not None else None)
+        table = self.collection
+        self.sql = {
+            'select': f"SELECT timestamp, session_id, client_ip, data, version FROM {table} WHERE session_id=? AND client_ip=?",
+            'version': f"SELECT version FROM {table} WHERE session_id=? AND client_ip=?",
+            'insert': f"INSERT INTO {table} (timestamp, session_id, client_ip, data) VALUES (?, ?, ?, ?)",
+            'update': f"UPDATE {table} SET data=?, timestamp=?, version=version+1 WHERE session_id=? AND client_ip=?",
+            'batch_select': f"SELECT session_id, data, version FROM {table} WHERE client_ip=? AND session_id IN ({{marks}})",
+            'batch_delete': f"DELETE FROM {table} WHERE client_ip=? AND session_id IN ({{marks}})",
+        }
 
     @staticmethod
     async def new(**kwargs):
         global electrolux_run_flag
         """
-        set up a new instance of SessionSqlite along with initializing
-        the vacuum task to sweep away old sessions
+        set up a new instance of SessionSqlite, opening each shard with its
+        connection pool and the vacuum task to sweep away old sessions
         """
-        global db_vacuum
         inst = SessionSqlite(**kwargs)
-        async with inst.sem:
-            con = sqlite3.connect(inst.database)
-            cur = con.cursor()
-            cur.execute(sqlite3_create_sql(inst.collection));
-            cur.close()
-
-        """
-        This is where we set up the vacuum with electrolux. It's intentionally
-        set up to be completely independent other than the Lock it uses. 
-        """
-        vargs = {
-            'database': inst.database,
-            'table': inst.collection,
-            'sem': inst.sem, 
-            'ttl': inst.session_ttl,
-            'interval': kwargs.get('vacuum_interval',60),
-            'log': inst.log,
-        }
-        if  not db_vacuum:  # onlt set up one vacuum
-            electrolux_run_flag = True
-            try:
-                db_vacuum = asyncio.create_task(electrolux(**vargs),name="vacuum_thread:electrolux")
-            except Exception as e:
-                inst.log.exception(f"{type(e)}: Error starting vacuum thread, {e}")
+        electrolux_run_flag = True
+        try:
+            for shard in inst.shards:
+                await shard.open(ttl=inst.session_ttl, **kwargs)
             await asyncio.sleep(.2)
-            if db_vacuum.done():
-                e = db_vacuum.exception()
-                if e:
-                    raise e
-                inst.log.info(f"Created vacuum task {db_vacuum.get_name()}")
-
+            for shard in inst.shards:
+                if shard.vacuum.done():
+                    e = shard.vacuum.exception()
+                    if e:
+                        raise e
+        except Exception:
+            inst.close()
+            raise
+        inst.log.info(f"Created vacuum tasks for {len(inst.shards)} sqlite session database(s)")
         return inst
 
-    def connect_db(self):
-        if not self.db_con or is_connection_closed(self.db_con):
-            try:
-                self.db_con = sqlite3.connect(self.database)
-            except Exception as e:
-                self.log.exception(f"connect_db: {type(e)}: Cannot open  sqlite3 database {self.database}: {e}")
-                raise
-        return self.db_con 
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def shard(self, session_id):
+        """ the shard session_id lives in """
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[zlib.crc32(session_id.encode('utf-8')) % len(self.shards)]
 
     async def _get_session_record(self, session_id,client_ip):
-        con = self.connect_db()
-        cur = con.cursor()
-        cur.row_factory = sqlite3.Row
-        session = None
-        timestamp = int(time.time())
-        try:
-            async with db_semaphore:
-                cur.execute(f"SELECT * from {self.collection} where session_id=? and client_ip=?",(session_id,client_ip))
-                r = cur.fetchone()
-                if r:
-                    session={k: r[k] for k in r.keys()}
-                    cur.execute(f"UPDATE {self.collection} set timestamp=? where session_id=? and client_ip=?",(timestamp,session_id,client_ip))
-                    if not cur.rowcount:
-                        self.log.error(f"Update {session_id} failed.")
-                        session = None
-                    else:
-                        self.log.debug(f"get_session_record updated {cur.rowcount}")
-                        con.commit()
-        except Exception as  e:
-            raise
-        finally:
-            return session
+        shard = self.shard(session_id)
+        row = await shard.pool.read(_fetchone, self.sql['select'], (session_id, client_ip))
+        if not row:
+            return None
+        # the ttl refresh is written behind, batched with other touches
+        shard.touches.touch(session_id, client_ip, int(time.time()))
+        return {'timestamp': row[0], 'session_id': row[1], 'client_ip': row[2], 'data': row[3], 'version': row[4]}
+
+    async def get_session_entry(self, session_id, client_ip):
+        session = await self._get_session_record(session_id,client_ip)
+        if not session:
+            return None
+        return self._decode_data(session['data']), session['version'], None
+
+    async def session_version(self, session_id, client_ip):
+        row = await self.shard(session_id).pool.read(_fetchone, self.sql['version'], (session_id, client_ip))
+        return row[0] if row else None
+
+    def touch_session(self, session_id, client_ip):
+        self.shard(session_id).touches.touch(session_id, client_ip, int(time.time()))
+
+    def stats(self):
+        if len(self.shards) == 1:
+            return self.shards[0].stats()
+        return {'shards': [shard.stats() for shard in self.shards]}
+
+    async def run_batch(self, client_ip, operations):
+        """
+        the operations are grouped by shard and each shard's run in one
+        transaction on its writer, or on a reader when they are all gets.
+        Shards run in parallel; a shard that fails fails all its operations.
+        """
+        by_shard = {}
+        for index, op, session_id, data in operations:
+            if op == 'create':
+                session_id = str(uuid.uuid4())
+            value = self._encode_data(data) if op in ('create', 'update') else None
+            by_shard.setdefault(self.shard(session_id), []).append((index, op, session_id, data, value))
+        shards = list(by_shard.items())
+        done = await asyncio.gather(*[self._shard_batch(shard, client_ip, ops) for shard, ops in shards],
+                                    return_exceptions=True)
+        results = {}
+        now = int(time.time())
+        for (shard, ops), outcome in zip(shards, done):
+            if isinstance(outcome, Exception):
+                self.log.error(f"sessman: batch of {len(ops)} on {shard.database} failed: {type(outcome).__name__}: {outcome}")
+                for index, op, session_id, _, _ in ops:
+                    results[index] = {'status': 500, 'session_id': None if op == 'create' else session_id,
+                                      'error': f"{type(outcome).__name__}: {outcome}"}
+                continue
+            for index, op, session_id, data, _ in ops:
+                status, row = outcome[index]
+                result = results[index] = {'status': status, 'session_id': session_id}
+                if status == 404:
+                    result['error'] = f"Session ID {session_id} for {client_ip} not found."
+                elif op == 'get':
+                    result['data'] = self._decode_data(row[0])
+                    shard.touches.touch(session_id, client_ip, now)
+                elif op in ('create', 'update'):
+                    result['data'] = data
+        return results
+
+    async def _shard_batch(self, shard, client_ip, ops):
+        runs = batch_runs([(index, op, session_id, value) for index, op, session_id, _, value in ops], lambda op: op)
+        if all(op == 'get' for op, _ in runs):
+            return await shard.pool.read(_session_batch, self.sql, client_ip, runs)
+        return await shard.pool.write(_session_batch, self.sql, client_ip, runs)
 
     async def create_session(self,**kwargs):
         data = kwargs.get('data',{})
@@ -220,15 +950,9 @@ class SessionSqlite(SessionDatabase):
             raise ValueError("required argument, client_ip, not set")
 
         bdata = self._encode_data(data)
-        async with self.sem:
-            con = self.connect_db()
-            cur = con.cursor();
-            cur.execute(f"INSERT INTO {self.collection} VALUES (?, ?, ?, ?)", (time_in, session_id, client_ip, bdata))
-            if not cur.rowcount:
-                self.log(f"Insert session id failed")
-            else:                
-                con.commit()
-            cur.close()
+        inserted = await self.shard(session_id).pool.write(_execute, self.sql['insert'], (time_in, session_id, client_ip, bdata))
+        if not inserted:
+            self.log(f"Insert session id failed")
         self.log(f"create_session - created session_id {session_id}")
         return session_id
 
@@ -246,13 +970,10 @@ class SessionSqlite(SessionDatabase):
             raise ValueError("required argument, data, not set")
 
         self.data = data
-        async with self.sem:
-            bdata = self._encode_data(data)
-            con = self.connect_db()
-            cur = con.cursor();
-            cur.execute(f"UPDATE {self.collection} SET data=?, timestamp=? WHERE session_id=? and client_ip=?",(bdata,time_in, session_id, client_ip))
-            con.commit()
-            cur.close()
+        bdata = self._encode_data(data)
+        updated = await self.shard(session_id).pool.write(_execute, self.sql['update'], (bdata, time_in, session_id, client_ip))
+        if not updated:
+            raise KeyError(f"Session ID {session_id} for {client_ip} not found.")
         return data
 
     async def get_session(self,**kwargs):
@@ -265,13 +986,29 @@ class SessionSqlite(SessionDatabase):
         if not session_id:
             raise ValueError("required argument, session_id, not set")
 
-        session = await self._get_session_record(session_id,client_ip)
-        if session:
-            data = self._decode_data(session['data'])
+        entry = await self.get_session_entry(session_id,client_ip)
+        if entry:
+            data = entry[0]
         return data
 
 
+def async_mongo_client():
+    """ the asyncio MongoDB client class: pymongo's own (4.9+), or motor's """
+    try:
+        from pymongo import AsyncMongoClient
+        return AsyncMongoClient
+    except ImportError:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient
+
+EPOCH = datetime(1970, 1, 1)     # createdAt is a naive UTC datetime
+
 class SessionMongoDB(SessionDatabase):
+    """
+    MongoDB sessions through an asyncio client. Requests share the client's
+    connection pool, sized with pool_size and min_pool_size, and no lock is
+    held around database calls.
+    """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         for k in ['database','username','password']:
@@ -282,18 +1019,26 @@ class SessionMongoDB(SessionDatabase):
         if not self.database:
             raise ValueError('database must be specified')
         self.server_url = f"mongodb://{self.username}:{self.password}@{url}/{self.database}?authSource={self.database}"
-        self.client = MongoClient(self.server_url)
+        self.client = async_mongo_client()(
+            self.server_url,
+            maxPoolSize=int(kwargs.get('pool_size', 100)),
+            minPoolSize=int(kwargs.get('min_pool_size', 0)),
+            serverSelectionTimeoutMS=int(kwargs.get('server_selection_timeout_ms', 5000)))
         self.db = self.client[self.database]  # Database name
         self.sessions = self.db[self.collection]  # Collection for sessions
         self.log = kwargs.get('log')
-        # Create TTL Index on the 'createdAt' field
-        # Set the expiration time to 30 minutes (1800 seconds)
-        self.sessions.create_index([('createdAt', 1)], expireAfterSeconds=self.session_ttl)
-
 
     @staticmethod
     async def new(**kwargs):
-        return SessionMongoDB(**kwargs)
+        inst = SessionMongoDB(**kwargs)
+        # Create TTL Index on the 'createdAt' field, sessions expire session_ttl after they're created
+        await inst.sessions.create_index([('createdAt', 1)], expireAfterSeconds=inst.session_ttl)
+        return inst
+
+    async def close(self):
+        closing = self.client.close()
+        if inspect.isawaitable(closing):    # AsyncMongoClient.close is a coroutine, motor's isn't
+            await closing
 
     async def create_session(self, **kwargs):
         """Create a new session and insert into MongoDB, using ObjectId as sessionId."""
@@ -304,12 +1049,12 @@ class SessionMongoDB(SessionDatabase):
             'client_ip': client_ip,
             'createdAt': created_at,
             'updatedAt': created_at,  # Can be updated later
+            'version': 0,             # bumped by every update
             'data': data  # Store any session data (e.g., user preferences, tokens, etc.)
         }
 
         # Insert the session into the MongoDB collection
-        async with self.sem:
-            result = self.sessions.insert_one(session)
+        result = await self.sessions.insert_one(session)
         session_id = str(result.inserted_id)  # Get the ObjectId and convert to string
         return session_id
 
@@ -317,33 +1062,120 @@ class SessionMongoDB(SessionDatabase):
         """Retrieve a session from MongoDB by session ID (ObjectId)."""
         client_ip = kwargs.get('client_ip','noip')
         session_id = kwargs.get('session_id')
-        session = None
-        async with self.sem:
-            session = self.sessions.find_one({'_id': ObjectId(session_id), 'client_ip': client_ip})
+        entry = await self.get_session_entry(session_id, client_ip)
+        if entry:
+            return entry[0]
+        return None
+
+    async def get_session_entry(self, session_id, client_ip):
+        session = await self.sessions.find_one({'_id': ObjectId(session_id), 'client_ip': client_ip},
+                                               {'data': 1, 'version': 1, 'createdAt': 1})
+        if session:
+            created = session.get('createdAt')
+            expires = (created - EPOCH).total_seconds() + self.session_ttl if created else None
+            return session.get('data'), session.get('version', 0), expires
+        return None
+
+    def session_expires(self):
+        # the TTL index removes a session session_ttl after createdAt, using it doesn't extend that
+        return time.time() + self.session_ttl
 
+    async def session_version(self, session_id, client_ip):
+        session = await self.sessions.find_one({'_id': ObjectId(session_id), 'client_ip': client_ip}, {'version': 1})
         if session:
-            return session.data
+            return session.get('version', 0)
         return None
 
     async def update_session(self, **kwargs):
-        """Update the session's 'data' field using ObjectId as sessionId."""
+        """Update the session's 'data' field using ObjectId as sessionId, in one round trip."""
         client_ip = kwargs.get('client_ip','noip')
         session_id = kwargs.get('session_id')
         data = kwargs.get('data',{})
-        async with self.sem:
-            session = self.sessions.find_one({'_id': ObjectId(session_id), 'client_ip': client_ip})
-            if not session:
-                raise KeyError(f"Session ID {session_id} for {client_ip} not found.")
-            session['updatedAt'] = datetime.utcnow()
-            session['data'] = data
-            update_result = self.sessions.update_one(
-                {'_id': ObjectId(session_id), 'client_ip': client_ip},
-                {"$set": {'updatedAt': session['updatedAt'], 'data': session['data']}}
-            )
-            if update_result.modified_count > 0:
-                return data
-            return None
-        return None
+        session = await self.sessions.find_one_and_update(
+            {'_id': ObjectId(session_id), 'client_ip': client_ip},
+            {"$set": {'updatedAt': datetime.utcnow(), 'data': data}, "$inc": {'version': 1}},
+            projection={'_id': 1})
+        if not session:
+            raise KeyError(f"Session ID {session_id} for {client_ip} not found.")
+        return data
+
+    async def run_batch(self, client_ip, operations):
+        """
+        gets are read with one $in query per run of them; the writes in
+        between go out as one ordered bulk_write, after a $in lookup that
+        tells which sessions exist. MongoDB has no transaction across
+        documents without a replica set, so when the bulk write stops at an
+        error the writes before it stay done and the ones after it fail.
+        """
+        results = {}
+        for kind, ops in batch_runs(operations, lambda op: 'read' if op == 'get' else 'write'):
+            ids = {}
+            for index, op, session_id, _ in ops:
+                if op == 'create':
+                    continue
+                try:
+                    ids[session_id] = ObjectId(session_id)
+                except (InvalidId, TypeError):
+                    results[index] = {'status': 400, 'session_id': session_id, 'error': f"invalid session id {session_id}"}
+            query = {'_id': {'$in': list(ids.values())}, 'client_ip': client_ip}
+            if kind == 'read':
+                found = {}
+                if ids:
+                    async for session in self.sessions.find(query, {'data': 1}):
+                        found[str(session['_id'])] = session.get('data')
+                for index, _, session_id, _ in ops:
+                    if index in results:
+                        continue
+                    if session_id in found:
+                        results[index] = {'status': 200, 'session_id': session_id, 'data': found[session_id]}
+                    else:
+                        results[index] = {'status': 404, 'session_id': session_id,
+                                          'error': f"Session ID {session_id} for {client_ip} not found."}
+                continue
+            existing = set()
+            if ids:
+                async for session in self.sessions.find(query, {'_id': 1}):
+                    existing.add(str(session['_id']))
+            requests, written = [], []
+            now = datetime.utcnow()
+            for index, op, session_id, data in ops:
+                if index in results:
+                    continue
+                if op == 'create':
+                    oid = ObjectId()
+                    session_id = str(oid)
+                    requests.append(InsertOne({'_id': oid, 'client_ip': client_ip, 'createdAt': now,
+                                               'updatedAt': now, 'version': 0, 'data': data}))
+                elif session_id not in existing:
+                    results[index] = {'status': 404, 'session_id': session_id,
+                                      'error': f"Session ID {session_id} for {client_ip} not found."}
+                    continue
+                elif op == 'update':
+                    requests.append(UpdateOne({'_id': ids[session_id], 'client_ip': client_ip},
+                                              {"$set": {'updatedAt': now, 'data': data}, "$inc": {'version': 1}}))
+                else:
+                    existing.discard(session_id)
+                    requests.append(DeleteOne({'_id': ids[session_id], 'client_ip': client_ip}))
+                written.append((index, session_id, None if op == 'delete' else data))
+            failed_at, error = len(written), None
+            if requests:
+                try:
+                    await self.sessions.bulk_write(requests, ordered=True)
+                except BulkWriteError as e:
+                    errors = e.details.get('writeErrors') or [{}]
+                    failed_at = errors[0].get('index', 0)
+                    error = errors[0].get('errmsg', str(e))
+                except Exception as e:
+                    failed_at, error = 0, f"{type(e).__name__}: {e}"
+            for position, (index, session_id, data) in enumerate(written):
+                if position < failed_at:
+                    results[index] = {'status': 200, 'session_id': session_id}
+                    if data is not None:
+                        results[index]['data'] = data
+                else:
+                    results[index] = {'status': 500, 'session_id': session_id,
+                                      'error': error if position == failed_at else "not run, an earlier write failed"}
+        return results
 
 async def SessionDbHandler(handler_type,**kwargs):
     handlers = {'sqlite': SessionSqlite, 'mongodb': SessionMongoDB}
@@ -369,6 +1201,13 @@ class Sessman(BasePlugin):
             raise ValueError('database must be specified')
         self.kwargs['log'] = self.log
         self.initialized = False
+        cache_entries = int(kwargs.get('cache_entries', 10000) or 0)
+        self.cache = SessionCache(ttl=self.session_ttl, max_entries=cache_entries,
+                                  max_bytes=int(kwargs.get('cache_bytes', 64 * 1024 * 1024))) if cache_entries > 0 else None
+        # other workers and processes sharing the database can change or delete
+        # its sessions, so only a single process setup can safely turn this off
+        self.cache_verify = configfile.value_bool(kwargs.get('cache_verify', True))
+        self.batch_max = int(kwargs.get('batch_max', 100))
 
     async def initialize(self,**kwargs):
         if not self.initialized:
@@ -376,9 +1215,96 @@ class Sessman(BasePlugin):
             self.initialized = True
             self.log.info(f"db backend initilized for {self.backend}")
 
-    def terminate_plugin(self):
+    async def terminate_plugin(self):
         global electrolux_run_flag
         electrolux_run_flag = False
+        close = getattr(getattr(self, 'db_handler', None), 'close', None)
+        if close:
+            closing = close()   # the MongoDB handler closes asynchronously
+            if inspect.isawaitable(closing):
+                await closing
+
+    async def get_session(self, args):
+        """
+        session data for args['session_id'], from the cache when it has it.
+        With cache_verify the cached version is checked against the
+        database first, so updates made by other workers are seen.
+        """
+        session_id = args.get('session_id')
+        client_ip = args.get('client_ip','noip')
+        if not self.cache:
+            return await self.db_handler.get_session(**args)
+        entry = self.cache.get(session_id, client_ip)
+        if entry is not None and self.cache_verify:
+            if await self.db_handler.session_version(session_id, client_ip) != entry.version:
+                self.cache.invalidate(session_id, client_ip, stale=True)
+                entry = None
+        if entry is not None:
+            self.db_handler.touch_session(session_id, client_ip)
+            return entry.data
+        generation = self.cache.generation()
+        found = await self.db_handler.get_session_entry(session_id, client_ip)
+        if found is None:
+            return None
+        data, version, expires = found
+        self.cache.put(session_id, client_ip, data, version, since=generation, expires=expires)
+        return data
+
+    async def run_batch(self, args):
+        """
+        run args['operations'], a list of {"op": get|update|create|delete,
+        "session_id": ..., "data": ...}, for the requesting client. Returns
+        the status code and a result per operation, in the same order:
+        200 when every operation succeeded, 207 when some didn't.
+        """
+        operations = args.get('operations')
+        client_ip = args.get('client_ip','noip')
+        if not isinstance(operations, list) or not operations:
+            return 400, {'error': 'operations must be a list of operations', 'locus': 'sessman.batch'}
+        if len(operations) > self.batch_max:
+            return 400, {'error': f"{len(operations)} operations, at most {self.batch_max} are allowed",
+                         'locus': 'sessman.batch'}
+        results = [None] * len(operations)
+        valid = []
+        for index, operation in enumerate(operations):
+            op = operation.get('op') if isinstance(operation, dict) else None
+            session_id = operation.get('session_id') if op else None
+            data = operation.get('data', {} if op == 'create' else None) if op else None
+            if op not in BATCH_OPS:
+                error = f"op must be one of {', '.join(BATCH_OPS)}"
+            elif op != 'create' and (not session_id or not isinstance(session_id, str)):
+                error = 'no session id'
+            elif op == 'update' and not data:
+                error = 'no data to update'
+            else:
+                valid.append((index, op, session_id, data))
+                continue
+            results[index] = {'status': 400, 'session_id': session_id, 'error': error}
+        generation = self.cache.generation() if self.cache else None
+        try:
+            done = await self.db_handler.run_batch(client_ip, valid) if valid else {}
+        except Exception as e:
+            self.log.exception(f"sessman: batch failed: {e}")
+            done = {index: {'status': 500, 'session_id': session_id, 'error': f"{type(e).__name__}: {e}"}
+                    for index, _, session_id, _ in valid}
+        finally:
+            if self.cache:
+                # dropped after the writes, like a single update
+                for index, op, session_id, _ in valid:
+                    if op in ('update', 'delete'):
+                        self.cache.invalidate(session_id, client_ip)
+        for index, op, _, data in valid:
+            result = done.get(index) or {'status': 500, 'error': 'no result'}
+            if op == 'create' and result['status'] == 200 and self.cache:
+                self.cache.put(result['session_id'], client_ip, data, 0, since=generation,
+                               expires=self.db_handler.session_expires())
+            results[index] = result
+        failed = 0
+        for operation, result in zip(operations, results):
+            result['op'] = operation.get('op') if isinstance(operation, dict) else None
+            if result['status'] != 200:
+                failed += 1
+        return (207 if failed else 200), {'results': results, 'failed': failed}
 
     async def request_handler(self,**args):
 #        if not self.initialized:
@@ -397,6 +1323,9 @@ class Sessman(BasePlugin):
                 if sessid:
                     code = 200
                     response_data = {'session_id': sessid}
+                    if self.cache:
+                        self.cache.put(sessid, args.get('client_ip','noip'), args.get('data',{}), 0,
+                                       expires=self.db_handler.session_expires())
             except Exception as e:
                 code = 404
                 response_data['error'] = f"Cannot get new session id {e}"
@@ -420,6 +1349,11 @@ class Sessman(BasePlugin):
                     code = 400
                     response_data['error'] = f"Cannot get update session  for session  id {e}"
                     response_data['locus'] = "sessman.update"
+                finally:
+                    if self.cache:
+                        # dropped after the write; the invalidation also stops a get that read
+                        # the old data before the write from caching it (see SessionCache.put)
+                        self.cache.invalidate(session_id, args.get('client_ip','noip'))
 
 
         elif args['subpath'] == 'get':
@@ -428,7 +1362,7 @@ class Sessman(BasePlugin):
                 response_data['error'] = 'no session id available'
             else:
                 try:
-                    data = await self.db_handler.get_session(**args)
+                    data = await self.get_session(args)
                     if data:
                         code = 200
                         response_data = {'session_id': args.get('session_id'), 'data': data} # Convert ObjectId to string for response
@@ -440,14 +1374,61 @@ class Sessman(BasePlugin):
                     code = 400
                     response_data['error'] = f"Cannot get session for session id {session_id}: {e}"
 
+        elif args['subpath'] == 'batch':
+            code, response_data = await self.run_batch(args)
+
+        elif args['subpath'] == 'stats':
+            code = 200
+            response_data = {'backend': self.backend, 'cache': self.cache.stats() if self.cache else None}
+            response_data.update(self.db_handler.stats())
+
         else:
             code = 400
             response_data = {'error': f"{args['subpath']} is not a valid endpoint"}
 
-        response = web.json_response(response_data,status=code);
+        response = jsoncodec.json_response(response_data,status=code);
         if(sessid):
             now_utc = datetime.now(pytz.utc)
             expiry_time = now_utc + timedelta(seconds=self.session_ttl)
             response.set_cookie('PS_SESSID',sessid, expires=expiry_time, httponly=True)
-        self.log.debug(f"{self._plugin_id}: response_handler {code}, {response_data}")
+        self.log.debugf("%s: response_handler %s, %s", self._plugin_id, code, response_data)
         return code, response
+
+def main():
+    """
+    offline maintenance of an sqlite session database, run from the server
+    directory while the server is stopped:
+
+        python -m plugins.sessman migrate --database sessions.db [--table sessions]
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('migrate',))
+    parser.add_argument('--database', required=True, help="sqlite session database file")
+    parser.add_argument('--table', default='sessions')
+    parser.add_argument('--format', default='json', choices=tuple(SERIALIZERS))
+    parser.add_argument('--compression', default='zlib', choices=tuple(COMPRESSORS))
+    parser.add_argument('--compress-min', type=int, default=1024)
+    parser.add_argument('--compress-level', type=int)
+    parser.add_argument('--all', action='store_true', help="re-encode every row, not just the legacy base64 ones")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="VACUUM afterwards to give the space back, and turn on incremental vacuum")
+    args = parser.parse_args()
+    payload = SessionPayload(serializer=args.format, compression=args.compression,
+                             compress_min=args.compress_min, compress_level=args.compress_level)
+    con = sqlite3.connect(args.database)
+    try:
+        sqlite3_migrate(con, args.table)
+        start = time.perf_counter()
+        rows, before, after = sqlite3_migrate_payloads(con, args.table, payload, rewrite=args.all)
+        print(f"{args.table}: {rows} sessions re-encoded in {time.perf_counter() - start:.2f}s, "
+              f"{before} bytes -> {after} bytes")
+        if args.vacuum:
+            # switching an existing database to incremental auto_vacuum takes a VACUUM
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute("VACUUM")
+    finally:
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -287,7 +287,7 @@ class SystemInfo(BasePlugin):
                 response_data = {'Error': f"{subpath} is not a member of response_data"}
                 code = 404;
 
-        print(f"systeminfo:request_handler:Returning {code} - {response_data}")
+        self.log.debugf("systeminfo:request_handler:Returning %s - %s", code, response_data)
         return code, response_data
     
 if __name__ == "__main__":